@@ -31,9 +31,54 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import cvp, optparse, smtplib
+'''
+   Check the compliance of every device known to CVP and email a report of
+   the devices that are not in compliance.
+
+   The checks run on --workers threads. --rate caps the number of
+   compliance calls per second across all threads, so a fleet sweep does
+   not overload CVP. Results are reported in the order CVP lists the
+   devices.
+
+   With --mode container one containerComplianceCheck is made for every
+   container that holds devices, optionally only below --container. A
+   container whose check reports nothing but compliance counts all its
+   devices as compliant; the devices of a container that reports a
+   problem, or whose check fails, are checked one by one.
+
+   With --state FILE the results are kept between runs together with a
+   fingerprint of every device: its container, image bundle, configlet
+   mapping and the content of its configlets. The next run only checks
+   the devices whose fingerprint moved, that were not in compliance or
+   whose check failed, and reuses the stored result for the others. The
+   cvp module reports no change timestamps for devices, so changes made
+   on the devices themselves are only caught by the full sweep, which
+   checks every device again every --full-sweep seconds.
+
+   With --history FILE every run is appended to a SQLite history, see
+   compliance_history.py, which the query subcommand reads:
+
+   compliance_check.py --history FILE query history --device NAME [--since T] [--until T]
+   compliance_check.py --history FILE query time-in-state --device NAME [--since T] [--until T]
+   compliance_check.py --history FILE query fleet [--since T] [--until T]
+
+   Times are epoch seconds or UTC dates as YYYY-MM-DD[THH:MM[:SS]].
+
+   Several CVP clusters are swept concurrently, each with its own
+   --workers threads and --rate limit, when -c lists several hosts
+   separated by commas or --clusters names a JSON file:
+
+   { "clusters": [ { "name": "east", "host": "cvp-east", "username": "u", "password": "p" }, ... ] }
+
+   The name defaults to the host and the credentials to -u and -p. One
+   report covers all clusters, the history records the cluster of every
+   run and --state keeps one file per cluster, FILE.<name>.
+'''
+
+import cvp, optparse, smtplib, threading, time, Queue, json, hashlib, os, sys, tempfile
 from email.mime.text import MIMEText
 from string import Template
+from compliance_history import HistoryStore, parseTime, formatTime
 
 # Compliance codes for devices and containers
 DEVICE_IN_COMPLIANCE = 0
@@ -64,46 +109,250 @@ complianceCodes = {
    DEVICE_UNAUTHORIZED_USER : 'Unauthorized User',
 }
 
-usage = 'usage: %prog [options]'
+usage = 'usage: %prog [options]\n       %prog --history FILE [options] query history|time-in-state|fleet'
 op = optparse.OptionParser(usage=usage)
 op.add_option( '-c', '--cvphostname', dest='cvphostname', action='store', help='CVP host name FQDN or IP', type='string')
 op.add_option( '-u', '--cvpusername', dest='cvpusername', action='store', help='CVP username', type='string')
 op.add_option( '-p', '--cvppassword', dest='cvppassword', action='store', help='CVP password', type='string')
+op.add_option( '--clusters', dest='clusters', action='store', help='JSON file listing the CVP clusters to sweep concurrently', type='string')
 op.add_option( '-e', '--email', dest='email', action='store', help='Sender address for email', type='string')
 op.add_option( '-r', '--recipient', dest='recipient', action='store', help='Recipient address for email', type='string')
 op.add_option( '-s', '--smtpserver', dest='smtpserver', action='store', help='IP address for SMTP server', type='string')
+op.add_option( '-w', '--workers', dest='workers', action='store', help='Number of compliance checks running concurrently', type='int', default=8)
+op.add_option( '-m', '--mode', dest='mode', action='store', help='device runs one compliance check per device, container one per container and per device only for containers with problems', type='choice', choices=['device','container'], default='device')
+op.add_option( '-t', '--container', dest='container', action='store', help='In container mode only check the devices in this container and the containers below it', type='string')
+op.add_option( '--state', dest='state', action='store', help='Keep results between runs in this file and only re-check devices that changed', type='string')
+op.add_option( '--full-sweep', dest='full_sweep', action='store', help='With --state, seconds between runs that check every device', type='int', default=86400)
+op.add_option( '--history', dest='history', action='store', help='Append the results of every run to this SQLite database, also read by the query subcommand', type='string')
+op.add_option( '--device', dest='device', action='store', help='Query: MAC address or FQDN of the device', type='string')
+op.add_option( '--since', dest='since', action='store', help='Query: start of the time range', type='string')
+op.add_option( '--until', dest='until', action='store', help='Query: end of the time range, defaults to now', type='string')
+op.add_option( '--rate', dest='rate', action='store', help='Maximum compliance checks per second towards CVP, 0 for no limit', type='float', default=20.0)
+
+class RateLimiter(object):
+	"""
+	Token bucket shared by the checker threads.
+
+	Variables:
+	self.rate - tokens added per second, 0 disables the limiter
+	self.burst - maximum number of tokens in the bucket
+
+	Functions:
+	acquire - take one token, sleeping until one is available
+	"""
+
+	def __init__( self , rate , burst=1 ):
+		self.rate = rate
+		self.burst = max( 1 , burst )
+		self.tokens = float( self.burst )
+		self.last = time.time()
+		self.lock = threading.Lock()
+
+	def acquire( self ):
+		if self.rate <= 0:
+			return
+		while True:
+			with self.lock:
+				now = time.time()
+				self.tokens = min( self.burst , self.tokens + ( now - self.last ) * self.rate )
+				self.last = now
+				if self.tokens >= 1:
+					self.tokens = self.tokens - 1
+					return
+				wait = ( 1 - self.tokens ) / self.rate
+			time.sleep( wait )
+
+def runConcurrently( function , items , workers , limiter ):
+	"""
+	Call function for every item on worker threads, taking a token from
+	the limiter before each call.
+
+	Returns a list of ( item , result , error ) in the order of items. The
+	result is None and error holds the message when the call failed.
+	"""
+	results = [ None ] * len( items )
+	queue = Queue.Queue()
+	for index, item in enumerate( items ):
+		queue.put( ( index , item ) )
+
+	def worker():
+		while True:
+			try:
+				index, item = queue.get_nowait()
+			except Queue.Empty:
+				return
+			limiter.acquire()
+			try:
+				results[index] = ( item , function( item ) , None )
+			except Exception as e:
+				results[index] = ( item , None , str( e ) )
+
+	threads = [ threading.Thread( target=worker ) for counter in range( min( max( 1 , workers ) , max( 1 , len( items ) ) ) ) ]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return results
+
+def checkDevices( server , devices , workers , limiter ):
+	"""
+	Run deviceComplianceCheck for every device, returns a list of
+	( device , compliance code , error ) in the order of devices.
+	"""
+	return runConcurrently( server.deviceComplianceCheck , devices , workers , limiter )
+
+def subtreeContainers( containers , root ):
+	"""
+	Names of the container root and every container below it.
+	"""
+	children = {}
+	for container in containers:
+		children.setdefault( container.parentName , [] ).append( container.name )
+	names = set()
+	pending = [ root ]
+	while pending:
+		name = pending.pop()
+		if name not in names:
+			names.add( name )
+			pending.extend( children.get( name , [] ) )
+	return names
+
+def containerCompliant( events ):
+	"""
+	True when every event of a container compliance check reports the
+	container in compliance. A check that returned nothing proves nothing,
+	its devices are checked one by one like for a failed check.
+	"""
+	if events is None:
+		return False
+	return all( getattr( event , 'complianceCode' , event ) == DEVICE_IN_COMPLIANCE for event in events )
+
+def devicesBelow( devices , containers , root ):
+	"""
+	The devices in container root and the containers below it.
+	"""
+	if root not in containers:
+		raise ValueError( "container %s not found" % ( root ) )
+	selected = subtreeContainers( containers.values() , root )
+	return [ device for device in devices if getattr( device , 'containerName' , None ) in selected ]
+
+def checkContainers( server , devices , containers , workers , limiter ):
+	"""
+	Run containerComplianceCheck for every container, of the name keyed
+	containers, that holds one of the devices and expand the result to
+	its devices. Devices outside any known container, and the devices of
+	containers that report a problem or whose check failed, get a
+	deviceComplianceCheck each.
+
+	Returns ( results , container calls , device calls ) where results is a
+	list of ( device , compliance code , error ) in the order of devices.
+	"""
+	members = {}
+	for device in devices:
+		container_name = getattr( device , 'containerName' , None )
+		if container_name in containers:
+			members.setdefault( container_name , [] ).append( device )
+
+	container_results = runConcurrently( server.containerComplianceCheck , [ containers[name] for name in sorted( members ) ] , workers , limiter )
+	compliant = set( container.name for container, events, error in container_results if error is None and containerCompliant( events ) )
+
+	recheck = [ device for device in devices if getattr( device , 'containerName' , None ) not in compliant ]
+	device_results = dict( ( id( device ) , ( device , compliance , error ) ) for device, compliance, error in checkDevices( server , recheck , workers , limiter ) )
 
-opts, _ = op.parse_args()
+	results = []
+	for device in devices:
+		if id( device ) in device_results:
+			results.append( device_results[ id( device ) ] )
+		else:
+			results.append( ( device , DEVICE_IN_COMPLIANCE , None ) )
+	return results, len( container_results ), len( recheck )
 
-host = opts.cvphostname
-user = opts.cvpusername
-password = opts.cvppassword
-email = opts.email
-recipient = opts.recipient
-smtpserver = opts.smtpserver
+#
+# Incremental mode. The state file holds, keyed by device MAC address, the
+# fingerprint, compliance code and check time of every device, and the
+# time of the last full sweep.
+#
+
+def loadState( filename ):
+	if not os.path.exists( filename ):
+		return { 'full_sweep': 0, 'devices': {} }
+	with open( filename ) as state_file:
+		return json.load( state_file )
+
+def saveState( filename , state ):
+	"""
+	Replace the state file atomically, an interrupted run leaves the
+	previous state in place.
+	"""
+	directory = os.path.dirname( os.path.abspath( filename ) )
+	handle, tmpname = tempfile.mkstemp( dir=directory , prefix='.compliance-state' )
+	with os.fdopen( handle , 'w' ) as state_file:
+		json.dump( state , state_file , sort_keys=True )
+	os.rename( tmpname , filename )
 
-server = cvp.Cvp( host )
-server.authenticate( user , password )
+def configletDigests( server ):
+	"""
+	Name keyed SHA-1 of the content of every configlet, from one call.
+	"""
+	digests = {}
+	for configlet in server.getConfiglets():
+		config = configlet.config or ''
+		if isinstance( config , unicode ):
+			config = config.encode( 'utf-8' )
+		digests[configlet.name] = hashlib.sha1( config ).hexdigest()
+	return digests
 
-#container = server.getContainer(containerName)
-#events = server.containerComplianceCheck(container)
+def deviceFingerprint( device , digests ):
+	configlets = sorted( getattr( configlet , 'name' , configlet ) for configlet in getattr( device , 'configlets' , None ) or [] )
+	fingerprint = {
+					'container': getattr( device , 'containerName' , None ),
+					'image': str( getattr( device , 'imageBundle' , None ) ),
+					'configlets': [ ( name , digests.get( name ) ) for name in configlets ]
+				  }
+	return hashlib.sha1( json.dumps( fingerprint , sort_keys=True ) ).hexdigest()
 
-#for event in events:
-#	print event.complianceCode
+def selectDevices( devices , state , fingerprints , full ):
+	"""
+	Split devices into the ones to check and a MAC keyed dictionary of the
+	stored compliance code of the others.
+	"""
+	check = []
+	cached = {}
+	for device in devices:
+		previous = state['devices'].get( device.macAddress )
+		if full or previous is None or previous['fingerprint'] != fingerprints[device.macAddress] or previous['compliance'] != DEVICE_IN_COMPLIANCE:
+			check.append( device )
+		else:
+			cached[device.macAddress] = previous['compliance']
+	return check, cached
 
-devices = server.getDevices()
-nonCompliant = []
-body = ""
+def updateState( state , results , fingerprints , now , full ):
+	for device, compliance, error in results:
+		if error is None:
+			state['devices'][device.macAddress] = { 'fqdn': device.fqdn, 'fingerprint': fingerprints[device.macAddress], 'compliance': compliance, 'checked': now }
+		else:
+			state['devices'].pop( device.macAddress , None )
+	if full:
+		state['full_sweep'] = now
 
-for device in devices:
-	compliance = server.deviceComplianceCheck(device)
-	if compliance != 0:
-		nonCompliantMessage = complianceCodes[compliance]
-		nonCompliantDevice = {	'device': device.fqdn,
-								'message': nonCompliantMessage }
-		nonCompliant.append(nonCompliantDevice)
+def nonCompliantDevices( results , cluster=None ):
+	nonCompliant = []
+	for device, compliance, error in results:
+		if error is not None:
+			nonCompliantMessage = 'Compliance check failed: %s' % ( error )
+		elif compliance != 0:
+			nonCompliantMessage = complianceCodes.get( compliance , 'Unknown compliance code %s' % ( compliance ) )
+		else:
+			continue
+		nonCompliant.append( {	'device': cluster and "%s (%s)" % ( device.fqdn , cluster ) or device.fqdn,
+								'message': nonCompliantMessage } )
+	return nonCompliant
 
-if nonCompliant:
+def reportBody( nonCompliant , failedClusters=[] ):
+	body = ""
+	for cluster, error in failedClusters:
+		body = body + "\nCluster %s could not be checked: %s\n\n" % ( cluster , error )
 	for nonCompliantDevice in nonCompliant:
 		Replacements = {
 							'device': nonCompliantDevice['device'],
@@ -115,16 +364,191 @@ Device $device is non-compliant due to: $message
 
 """).safe_substitute(Replacements)
 		body = body + tmpbody
+	return body
 
+def sendReport( opts , body ):
 	msg = MIMEText(body)
 	msg['Subject'] = 'Device compliance report'
-	msg['From'] = email
-	msg['To'] = recipient
+	msg['From'] = opts.email
+	msg['To'] = opts.recipient
 	msg = msg.as_string()
 
+	emailserver = smtplib.SMTP(opts.smtpserver, 25)
+	emailserver.sendmail(opts.email, opts.recipient, msg)
+	emailserver.quit()
+
+def formatDuration( seconds ):
+	minutes, seconds = divmod( int( seconds ) , 60 )
+	hours, minutes = divmod( minutes , 60 )
+	days, hours = divmod( hours , 24 )
+	return "%sd %02d:%02d:%02d" % ( days , hours , minutes , seconds )
+
+def query( opts , args ):
+	"""
+	The query subcommand, prints from the history database without
+	contacting CVP.
+	"""
+	if not opts.history:
+		op.error( "query needs --history" )
+	if len( args ) != 1 or args[0] not in ( 'history' , 'time-in-state' , 'fleet' ):
+		op.error( "query one of history, time-in-state, fleet" )
+	if args[0] != 'fleet' and not opts.device:
+		op.error( "query %s needs --device" % ( args[0] ) )
 	try:
-		emailserver = smtplib.SMTP(smtpserver, 25)
-		emailserver.sendmail(email, recipient, msg)
-		emailserver.quit()
-	except:
-		raise
+		since = parseTime( opts.since )
+		until = parseTime( opts.until )
+	except ValueError as e:
+		op.error( str( e ) )
+
+	store = HistoryStore( opts.history )
+	if args[0] == 'history':
+		for result in store.deviceHistory( opts.device , since , until ):
+			message = result['error'] or complianceCodes.get( result['compliance'] , result['compliance'] )
+			print "%s %s %s" % ( formatTime( result['ts'] ) , result['fqdn'] , message )
+	elif args[0] == 'time-in-state':
+		report = store.timeInState( opts.device , since , until )
+		if report is None:
+			print "No results for %s" % ( opts.device )
+		else:
+			print "%s is %s since %s (%s)" % ( opts.device , report['state'] , formatTime( report['since'] ) , formatDuration( report['seconds_in_state'] ) )
+			for state in sorted( report['durations'] ):
+				print "   %-12s %s" % ( state , formatDuration( report['durations'][state] ) )
+	else:
+		report = store.fleetCompliance( since , until )
+		for run in report['runs']:
+			print "%s %6.2f%% of %s devices in compliance, %s not, %s failed" % ( formatTime( run['started'] ) , run['percent'] , run['devices'] , run['noncompliant'] , run['failed'] )
+		print "%s runs, average %.2f%%, min %.2f%%, max %.2f%%" % ( len( report['runs'] ) , report['average_percent'] , report['min_percent'] , report['max_percent'] )
+	store.close()
+
+def loadClusters( opts ):
+	"""
+	The clusters to sweep as a list of dictionaries with name, host,
+	username and password.
+	"""
+	if opts.clusters:
+		with open( opts.clusters ) as clusters_file:
+			clusters = json.load( clusters_file )['clusters']
+	else:
+		clusters = [ { 'host': host.strip() } for host in ( opts.cvphostname or '' ).split( ',' ) if host.strip() ]
+	for cluster in clusters:
+		cluster.setdefault( 'name' , cluster['host'] )
+		cluster.setdefault( 'username' , opts.cvpusername )
+		cluster.setdefault( 'password' , opts.cvppassword )
+	return clusters
+
+def sweepCluster( cluster , opts , stateFile ):
+	"""
+	Check the devices of one CVP cluster. Returns a dictionary with the
+	results in device order, the number of container and device calls and
+	the run time, and the number of devices reused in incremental mode.
+	"""
+	server = cvp.Cvp( cluster['host'] )
+	server.authenticate( cluster['username'] , cluster['password'] )
+
+	devices = server.getDevices()
+	limiter = RateLimiter( opts.rate )
+	if opts.mode == "container":
+		containers = dict( ( container.name , container ) for container in server.getContainers() )
+		if opts.container:
+			devices = devicesBelow( devices , containers , opts.container )
+
+	#
+	# In incremental mode only the devices that changed, or were not in
+	# compliance, are checked.
+	#
+
+	now = time.time()
+	check = devices
+	if stateFile:
+		state = loadState( stateFile )
+		full = now - state['full_sweep'] >= opts.full_sweep
+		digests = configletDigests( server )
+		fingerprints = dict( ( device.macAddress , deviceFingerprint( device , digests ) ) for device in devices )
+		check, cached = selectDevices( devices , state , fingerprints , full )
+
+	if opts.mode == "container":
+		checked, container_calls, device_calls = checkContainers( server , check , containers , opts.workers , limiter )
+	else:
+		checked = checkDevices( server , check , opts.workers , limiter )
+		container_calls, device_calls = 0 , len( check )
+
+	sweep = { 'checked': len( checked ), 'container_calls': container_calls, 'device_calls': device_calls, 'now': now, 'cached': None, 'full': False }
+	if stateFile:
+		updateState( state , checked , fingerprints , now , full )
+		saveState( stateFile , state )
+		sweep['cached'] = len( cached )
+		sweep['full'] = full
+		checked_by_mac = dict( ( result[0].macAddress , result ) for result in checked )
+		sweep['results'] = [ checked_by_mac.get( device.macAddress ) or ( device , cached[device.macAddress] , None ) for device in devices ]
+	else:
+		sweep['results'] = checked
+	return sweep
+
+def sweepClusters( clusters , opts ):
+	"""
+	Run sweepCluster for every cluster on its own thread. Returns a list of
+	( cluster , sweep , error ) in the order of clusters.
+	"""
+	sweeps = [ None ] * len( clusters )
+
+	def sweeper( index , cluster ):
+		stateFile = opts.state
+		if stateFile and len( clusters ) > 1:
+			stateFile = "%s.%s" % ( opts.state , cluster['name'] )
+		try:
+			sweeps[index] = ( cluster , sweepCluster( cluster , opts , stateFile ) , None )
+		except Exception as e:
+			sweeps[index] = ( cluster , None , str( e ) )
+
+	threads = [ threading.Thread( target=sweeper , args=( index , cluster ) ) for index, cluster in enumerate( clusters ) ]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return sweeps
+
+def main():
+	opts, args = op.parse_args()
+
+	if args:
+		if args[0] != 'query':
+			op.error( "unknown subcommand %s" % ( args[0] ) )
+		query( opts , args[1:] )
+		return
+
+	try:
+		clusters = loadClusters( opts )
+	except ( IOError , ValueError , KeyError ) as e:
+		op.error( "invalid clusters file: %s" % ( e ) )
+	if not clusters:
+		op.error( "no CVP host given" )
+	multiple = len( clusters ) > 1
+
+	nonCompliant = []
+	failedClusters = []
+	for cluster, sweep, error in sweepClusters( clusters , opts ):
+		prefix = multiple and "%s: " % ( cluster['name'] ) or ""
+		if error is not None:
+			print "%sfailed: %s" % ( prefix , error )
+			failedClusters.append( ( cluster['name'] , error ) )
+			continue
+		print "%sChecked %s devices with %s container and %s device compliance calls" % ( prefix , sweep['checked'] , sweep['container_calls'] , sweep['device_calls'] )
+		if sweep['cached'] is not None:
+			print "%s%s devices unchanged since the last run%s" % ( prefix , sweep['cached'] , sweep['full'] and ", full sweep" or "" )
+
+		if opts.history:
+			store = HistoryStore( opts.history )
+			store.recordRun( sweep['now'] , [ ( device.macAddress , device.fqdn , compliance , error ) for device, compliance, error in sweep['results'] ] , multiple and cluster['name'] or None )
+			store.close()
+
+		nonCompliant.extend( nonCompliantDevices( sweep['results'] , multiple and cluster['name'] or None ) )
+
+	if nonCompliant or failedClusters:
+		sendReport( opts , reportBody( nonCompliant , failedClusters ) )
+
+	if failedClusters:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+'''
+   Compliance result history used by compliance_check.py.
+
+   Every run is appended to a SQLite database: one row in runs with the
+   counts of the run, and one row per device in results. results is
+   indexed on ( mac , ts ) and ( fqdn , ts ) and runs on started, so the
+   history of a device and the fleet compliance over a time range are
+   index range scans, and the fleet figures come from the per run counts
+   instead of the result rows.
+
+   A result with compliance 0 is in compliance, any other code is out of
+   compliance, and a NULL code with an error means the check failed.
+'''
+
+import sqlite3, time, calendar
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY,
+	started REAL NOT NULL,
+	cluster TEXT,
+	devices INTEGER NOT NULL,
+	compliant INTEGER NOT NULL,
+	noncompliant INTEGER NOT NULL,
+	failed INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs ( started );
+CREATE TABLE IF NOT EXISTS results (
+	run_id INTEGER NOT NULL REFERENCES runs ( id ),
+	ts REAL NOT NULL,
+	mac TEXT NOT NULL,
+	fqdn TEXT,
+	compliance INTEGER,
+	error TEXT
+);
+CREATE INDEX IF NOT EXISTS results_mac_ts ON results ( mac , ts );
+CREATE INDEX IF NOT EXISTS results_fqdn_ts ON results ( fqdn , ts );
+"""
+
+def parseTime( value ):
+	"""
+	Seconds since the epoch from epoch seconds or an UTC date as
+	YYYY-MM-DD, YYYY-MM-DDTHH:MM or YYYY-MM-DDTHH:MM:SS.
+	"""
+	if value is None:
+		return None
+	try:
+		return float( value )
+	except ValueError:
+		pass
+	for layout in ( '%Y-%m-%dT%H:%M:%S' , '%Y-%m-%dT%H:%M' , '%Y-%m-%d' ):
+		try:
+			return float( calendar.timegm( time.strptime( value , layout ) ) )
+		except ValueError:
+			pass
+	raise ValueError( "invalid time %s" % ( value ) )
+
+def formatTime( seconds ):
+	return time.strftime( '%Y-%m-%dT%H:%M:%SZ' , time.gmtime( seconds ) )
+
+def resultState( compliance ):
+	if compliance is None:
+		return 'failed'
+	if compliance == 0:
+		return 'compliant'
+	return 'noncompliant'
+
+class HistoryStore(object):
+	"""
+	SQLite store of compliance runs.
+
+	Functions:
+	recordRun - append the results of one run in a single transaction
+	deviceHistory - results of a device, by MAC address or FQDN, in a time range
+	timeInState - current state of a device, since when, and time per state in a range
+	fleetCompliance - compliance percentage of every run in a time range and their average
+	"""
+
+	def __init__( self , filename ):
+		self.connection = sqlite3.connect( filename )
+		self.connection.execute( 'PRAGMA journal_mode=WAL' )
+		self.connection.executescript( SCHEMA )
+
+	def close( self ):
+		self.connection.close()
+
+	def recordRun( self , started , results , cluster=None ):
+		"""
+		results is a list of ( mac , fqdn , compliance code , error ).
+		"""
+		compliant = len( [ result for result in results if result[2] == 0 ] )
+		failed = len( [ result for result in results if result[2] is None ] )
+		with self.connection:
+			cursor = self.connection.execute( 'INSERT INTO runs ( started , cluster , devices , compliant , noncompliant , failed ) VALUES ( ? , ? , ? , ? , ? , ? )',
+											  ( started , cluster , len( results ) , compliant , len( results ) - compliant - failed , failed ) )
+			run_id = cursor.lastrowid
+			self.connection.executemany( 'INSERT INTO results ( run_id , ts , mac , fqdn , compliance , error ) VALUES ( ? , ? , ? , ? , ? , ? )',
+										 [ ( run_id , started , mac , fqdn , compliance , error ) for mac, fqdn, compliance, error in results ] )
+		return run_id
+
+	def deviceKey( self , device ):
+		"""
+		The indexed column that identifies device, a MAC address or FQDN.
+		"""
+		if self.connection.execute( 'SELECT 1 FROM results WHERE mac = ? LIMIT 1' , ( device , ) ).fetchone():
+			return 'mac'
+		return 'fqdn'
+
+	def deviceHistory( self , device , since=None , until=None ):
+		column = self.deviceKey( device )
+		rows = self.connection.execute( 'SELECT ts , fqdn , compliance , error FROM results WHERE %s = ? AND ts >= ? AND ts <= ? ORDER BY ts' % ( column ),
+										( device , since or 0 , until or time.time() ) )
+		return [ { 'ts': ts, 'fqdn': fqdn, 'compliance': compliance, 'state': resultState( compliance ), 'error': error } for ts, fqdn, compliance, error in rows ]
+
+	def timeInState( self , device , since=None , until=None ):
+		"""
+		Returns None for an unknown device, otherwise a dictionary with the
+		latest state of the device, when it entered that state and how long
+		it spent in every state between since and until. A state lasts from
+		its result until the next result of the device, the last one until
+		until.
+		"""
+		column = self.deviceKey( device )
+		until = until or time.time()
+		latest = self.connection.execute( 'SELECT ts , compliance FROM results WHERE %s = ? AND ts <= ? ORDER BY ts DESC LIMIT 1' % ( column ) , ( device , until ) ).fetchone()
+		if latest is None:
+			return None
+		state = resultState( latest[1] )
+		if state == 'compliant':
+			condition = 'compliance IS NULL OR compliance != 0'
+		elif state == 'noncompliant':
+			condition = 'compliance IS NULL OR compliance = 0'
+		else:
+			condition = 'compliance IS NOT NULL'
+		changed = self.connection.execute( 'SELECT MAX( ts ) FROM results WHERE %s = ? AND ts <= ? AND ( %s )' % ( column , condition ) , ( device , latest[0] ) ).fetchone()[0]
+		entered = self.connection.execute( 'SELECT MIN( ts ) FROM results WHERE %s = ? AND ts > ? AND ts <= ?' % ( column ) , ( device , changed if changed is not None else -1 , latest[0] ) ).fetchone()[0]
+
+		durations = { 'compliant': 0.0, 'noncompliant': 0.0, 'failed': 0.0 }
+		rows = self.connection.execute( 'SELECT ts , compliance FROM results WHERE %s = ? AND ts >= ? AND ts <= ? ORDER BY ts' % ( column ) , ( device , since or 0 , until ) ).fetchall()
+		for index, ( ts , compliance ) in enumerate( rows ):
+			end = until if index + 1 == len( rows ) else rows[index + 1][0]
+			durations[ resultState( compliance ) ] += end - ts
+		return { 'device': device, 'state': state, 'since': entered, 'seconds_in_state': until - entered, 'durations': durations }
+
+	def fleetCompliance( self , since=None , until=None , cluster=None ):
+		query = 'SELECT started , cluster , devices , compliant , noncompliant , failed FROM runs WHERE started >= ? AND started <= ?'
+		parameters = [ since or 0 , until or time.time() ]
+		if cluster is not None:
+			query = query + ' AND cluster = ?'
+			parameters.append( cluster )
+		runs = []
+		for started, run_cluster, devices, compliant, noncompliant, failed in self.connection.execute( query + ' ORDER BY started' , parameters ):
+			runs.append( { 'started': started, 'cluster': run_cluster, 'devices': devices, 'compliant': compliant, 'noncompliant': noncompliant, 'failed': failed,
+						   'percent': devices and 100.0 * compliant / devices or 0.0 } )
+		devices = sum( run['devices'] for run in runs )
+		return {
+				'runs': runs,
+				'average_percent': devices and 100.0 * sum( run['compliant'] for run in runs ) / devices or 0.0,
+				'min_percent': min( [ run['percent'] for run in runs ] or [ 0.0 ] ),
+				'max_percent': max( [ run['percent'] for run in runs ] or [ 0.0 ] )
+			   }
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+'''
+   IP address and ASN allocation for fabric_builder.py.
+
+   Addresses are handled as 32 bit integers, so pools can be of any size and
+   a pool definition can list several prefixes that are used one after the
+   other. A pool is given as comma separated CIDR prefixes, for example
+   "10.0.0.0/22,10.8.0.0/24". The old form of a prefix without the last
+   octet, for example "10.0.0.", is still accepted and means a /24.
+'''
+
+import socket, struct
+from array import array
+
+# Smallest array type that holds an IPv4 address
+ADDRESS_TYPECODE = 'I' if array( 'I' ).itemsize >= 4 else 'L'
+
+class AllocatorError(Exception):
+	''' Invalid pool definition or pool exhausted
+	'''
+	pass
+
+def ip2int( address ):
+	return struct.unpack( '!I' , socket.inet_aton( address ) )[0]
+
+def int2ip( value ):
+	return socket.inet_ntoa( struct.pack( '!I' , value ) )
+
+def parsePool( pool ):
+	"""
+	Parse a pool definition into a list of ( first , last ) integer ranges.
+	"""
+	ranges = []
+	for prefix in pool.split( ',' ):
+		prefix = prefix.strip()
+		if not prefix:
+			continue
+		if prefix.endswith( '.' ):
+			prefix = prefix + '0/24'
+		if '/' in prefix:
+			network, length = prefix.split( '/' , 1 )
+			length = int( length )
+		else:
+			network, length = prefix, 32
+		if length < 0 or length > 32:
+			raise AllocatorError( 'Invalid prefix length in pool %s' % ( prefix ) )
+		try:
+			first = ip2int( network )
+		except socket.error:
+			raise AllocatorError( 'Invalid address in pool %s' % ( prefix ) )
+		size = 1 << ( 32 - length )
+		first = first & ~( size - 1 ) & 0xFFFFFFFF
+		ranges.append( ( first , first + size - 1 ) )
+	if not ranges:
+		raise AllocatorError( 'Empty pool definition %r' % ( pool ) )
+	return ranges
+
+def poolPrefixes( pool ):
+	"""
+	CIDR prefixes of a pool definition, normalised to their network address.
+	"""
+	prefixes = []
+	for first, last in parsePool( pool ):
+		length = 32
+		while ( 1 << ( 32 - length ) ) < last - first + 1:
+			length = length - 1
+		prefixes.append( '%s/%s' % ( int2ip( first ) , length ) )
+	return prefixes
+
+class AddressPool(object):
+	"""
+	Hand out addresses and aligned address blocks from one or more prefixes.
+
+	Every allocation is O(1). The base address of every allocated block is
+	recorded in an array of 32 bit integers.
+
+	Variables:
+	self.pool - the pool definition the allocator was built from
+	self.ranges - list of ( first , last ) integer address ranges
+	self.assigned - array of allocated block base addresses
+
+	Functions:
+	allocate - allocate an aligned block of addresses and return its base as integer
+	address - allocate a single address and return it in dotted notation
+	link - allocate a /31 and return both addresses in dotted notation
+	skip - step over a number of addresses, used to start further into a pool
+	"""
+
+	__slots__ = ( 'pool' , 'ranges' , 'current' , 'next' , 'assigned' )
+
+	def __init__( self , pool , start=0 ):
+		self.pool = pool
+		self.ranges = parsePool( pool )
+		self.current = 0
+		self.next = self.ranges[0][0]
+		self.assigned = array( ADDRESS_TYPECODE )
+		self.skip( start )
+
+	def allocate( self , size=1 ):
+		while True:
+			base = ( self.next + size - 1 ) & ~( size - 1 )
+			if base + size - 1 <= self.ranges[self.current][1]:
+				self.next = base + size
+				self.assigned.append( base )
+				return base
+			if self.current + 1 >= len( self.ranges ):
+				raise AllocatorError( 'Address pool %s exhausted after %s allocations' % ( self.pool , len( self.assigned ) ) )
+			self.current = self.current + 1
+			self.next = self.ranges[self.current][0]
+
+	def address( self ):
+		return int2ip( self.allocate( 1 ) )
+
+	def link( self ):
+		base = self.allocate( 2 )
+		return int2ip( base ) , int2ip( base + 1 )
+
+	def skip( self , count ):
+		while count > 0:
+			first, last = self.ranges[self.current]
+			available = last - self.next + 1
+			if count < available:
+				self.next = self.next + count
+				return
+			if self.current + 1 >= len( self.ranges ):
+				raise AllocatorError( 'Address pool %s exhausted' % ( self.pool ) )
+			count = count - available
+			self.current = self.current + 1
+			self.next = self.ranges[self.current][0]
+
+	def first( self ):
+		return self.ranges[0][0]
+
+def leafAsn( spine_start_asn , leaf_number , mlag ):
+	"""
+	ASN of leaf number leaf_number (counting from 1). Both leafs of an MLAG
+	pair share the ASN of the odd numbered leaf.
+	"""
+	asn = spine_start_asn + leaf_number
+	if mlag == "yes" and asn % 2 == 0:
+		asn = asn - 1
+	return asn
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+'''
+   Benchmarks for fabric_builder.py on synthetic fabrics.
+
+   Nothing is sent to CVP. Pushes go to MockCvpServer, which sleeps for a
+   fixed round trip plus a time proportional to the configlet size to
+   stand in for CVP compiling and storing the configlet.
+
+   Benchmarks:
+   phases - wall time, peak RSS and output bytes of the model build, render
+            and push phases for every size and deployment type. Every
+            phase runs in a fresh process. The render and push processes
+            build the model first, "peak MB" is the peak of the process
+            including that model and "phase MB" the growth of the peak
+            during the phase itself.
+   peering - size of the spine BGP configlets and the time to push them
+             with --bgp-peering explicit compared to dynamic
+
+   Example:
+   python fabric_benchmark.py --sizes 2x4,16x256,64x2048 --types evpn peering
+   python fabric_benchmark.py --latency 0.01 --output phases.json phases
+'''
+
+import cvp, optparse, time, json, resource, multiprocessing, threading
+import fabric_builder
+from fabric_builder import CvpInventory, submitConfiglet, dcConfiglets, deviceConfiglets
+from fabric_model import buildFabric
+from fabric_push import ConfigletPusher
+
+class MockCvpServer(object):
+	"""
+	Stand-in for cvp.Cvp that only simulates the cost of a push.
+
+	Variables:
+	self.latency - seconds of round trip per call
+	self.throughput - configlet bytes per second CVP handles
+	self.calls - number of calls made
+	self.bytes - number of configlet bytes sent
+	"""
+
+	def __init__( self , latency , throughput ):
+		self.latency = latency
+		self.throughput = throughput
+		self.calls = 0
+		self.bytes = 0
+		self.lock = threading.Lock()
+
+	def getConfiglets( self ):
+		return []
+
+	def getContainers( self ):
+		return []
+
+	def addConfiglet( self , configlet ):
+		with self.lock:
+			self.calls = self.calls + 1
+			self.bytes = self.bytes + len( configlet.config )
+		time.sleep( self.latency + float( len( configlet.config ) ) / self.throughput )
+
+def syntheticOptions( spines , leafs , deploymenttype , **overrides ):
+	"""
+	Builder options for a fabric of the given size with address pools
+	large enough for 64 spines and 2048 leafs with 2 uplinks each.
+	"""
+	opts = fabric_builder.op.get_default_values()
+	settings = {
+				"dcname": "BENCH",
+				"spines": spines,
+				"leafs": leafs,
+				"mlag": "yes",
+				"mlagnetwork": "169.254.255.0/31",
+				"mlagtrunkinterfaces": "Ethernet47,Ethernet48",
+				"defaultgw": "10.0.0.1",
+				"mgmtnet": "10.0.0.0/16",
+				"mgmtnetmask": 16,
+				"vxlanloopback": "10.2.0.0/16",
+				"loopback": "10.1.0.0/16",
+				"linknetwork": "10.64.0.0/12",
+				"deploymenttype": deploymenttype,
+				"cvxserver": "10.0.0.2",
+				"virtual": "yes",
+				"uplinks": 2,
+				"syslogserver": "10.0.0.3",
+				"snmp_private": "private",
+				"snmp_public": "public",
+				"primary_ntp": "10.0.0.4",
+				"second_ntp": "10.0.0.5",
+				"log_facility": "local4",
+				"spine_start_asn": 65000,
+				"max_routes": 12000,
+				"max_evpn_routes": 24000
+			   }
+	settings.update( overrides )
+	for key, value in settings.items():
+		setattr( opts , key , value )
+	return opts
+
+def pushConfiglets( configlets , latency , throughput , workers ):
+	"""
+	Push ( name , config ) pairs to a MockCvpServer through the same
+	ConfigletPusher the builder uses, returns the elapsed seconds.
+	"""
+	server = MockCvpServer( latency , throughput )
+	pusher = ConfigletPusher( workers , 0 , 0 )
+	start = time.time()
+	for configlet_name, config in configlets:
+		pusher.submit( configlet_name , server.addConfiglet , cvp.Configlet( configlet_name , config ) )
+	pusher.join()
+	elapsed = time.time() - start
+	pusher.close()
+	return elapsed
+
+def peakRss():
+	"""
+	Peak resident set size of this process in kilobytes.
+	"""
+	return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+def renderPhase( fabric , opts ):
+	"""
+	Render every configlet without keeping them, returns the number of
+	configlets and of rendered bytes.
+	"""
+	configlets = dcConfiglets( fabric , opts )
+	count = len( configlets )
+	rendered = sum( len( config ) for configlet_name, container_name, config in configlets )
+	for device_name, configlets in deviceConfiglets( fabric , opts ):
+		count = count + len( configlets )
+		rendered = rendered + sum( len( config ) for configlet_name, container_name, config in configlets )
+	return count, rendered
+
+def pushPhase( fabric , opts , bench ):
+	"""
+	Render and stream the configlets through submitConfiglet, CvpInventory
+	and the bounded ConfigletPusher queue like a first build of the DC
+	does, returns the number of configlets and of pushed bytes.
+	"""
+	server = MockCvpServer( bench.latency , bench.throughput )
+	inventory = CvpInventory( server )
+	pusher = ConfigletPusher( bench.push_workers , 0 , 0 , bench.push_queue )
+	summary = { 'changed': 0, 'unchanged': 0, 'journaled': 0 }
+	for configlet_name, container_name, config in dcConfiglets( fabric , opts ):
+		submitConfiglet( server , inventory , pusher , None , opts , summary , configlet_name , config )
+	for device_name, configlets in deviceConfiglets( fabric , opts ):
+		for configlet_name, container_name, config in configlets:
+			submitConfiglet( server , inventory , pusher , None , opts , summary , configlet_name , config )
+	pusher.join()
+	pusher.close()
+	return server.calls, server.bytes
+
+def runPhase( case ):
+	"""
+	Run one phase on one synthetic fabric and return its record. Called in
+	a fresh process, so peak_rss_kb is the peak of this phase and the model
+	it works on, and phase_rss_kb how much the peak grew during the phase.
+	"""
+	deploymenttype, spines, leafs, phase, bench = case
+	opts = syntheticOptions( spines , leafs , deploymenttype , bgp_peering=bench.bgp_peering )
+	before = peakRss()
+	start = time.time()
+	fabric = buildFabric( opts )
+	if phase == 'build':
+		count, output = 0 , 0
+	else:
+		before = peakRss()
+		start = time.time()
+		if phase == 'render':
+			count, output = renderPhase( fabric , opts )
+		else:
+			count, output = pushPhase( fabric , opts , bench )
+	seconds = time.time() - start
+	peak = peakRss()
+	return {
+			'type': deploymenttype, 'spines': spines, 'leafs': leafs, 'phase': phase,
+			'seconds': seconds, 'peak_rss_kb': peak, 'phase_rss_kb': peak - before,
+			'bytes': output, 'configlets': count
+		   }
+
+PHASES = ( 'build' , 'render' , 'push' )
+
+def parseSizes( sizes ):
+	result = []
+	for size in sizes.split( ',' ):
+		spines, leafs = size.lower().split( 'x' )
+		result.append( ( int( spines ) , int( leafs ) ) )
+	return result
+
+def benchmarkPeering( bench ):
+	print "%-5s %-10s %-9s %10s %12s %12s %10s %10s" % ( "type" , "size" , "peering" , "lines" , "bytes" , "max bytes" , "render s" , "push s" )
+	for deploymenttype in bench.types.split( ',' ):
+		for spines, leafs in parseSizes( bench.sizes ):
+			for peering in ( 'explicit' , 'dynamic' ):
+				opts = syntheticOptions( spines , leafs , deploymenttype , bgp_peering=peering )
+				fabric = buildFabric( opts )
+				start = time.time()
+				configlets = [ ( spine.name + " BGP configuration" , fabric_builder.renderSpineBgpConfig( spine , fabric , opts ) ) for spine in fabric.spines ]
+				render_time = time.time() - start
+				push_time = pushConfiglets( configlets , bench.latency , bench.throughput , bench.push_workers )
+				print "%-5s %-10s %-9s %10s %12s %12s %10.3f %10.3f" % (
+							deploymenttype , "%sx%s" % ( spines , leafs ) , peering ,
+							sum( config.count( '\n' ) for configlet_name, config in configlets ) ,
+							sum( len( config ) for configlet_name, config in configlets ) ,
+							max( len( config ) for configlet_name, config in configlets ) ,
+							render_time , push_time )
+
+def benchmarkPhases( bench ):
+	results = []
+	print "%-5s %-10s %-7s %10s %10s %12s %10s %10s" % ( "type" , "size" , "phase" , "configlets" , "seconds" , "bytes" , "peak MB" , "phase MB" )
+	for deploymenttype in bench.types.split( ',' ):
+		for spines, leafs in parseSizes( bench.sizes ):
+			for phase_name in PHASES:
+				pool = multiprocessing.Pool( 1 )
+				try:
+					phase = pool.apply( runPhase , ( ( deploymenttype , spines , leafs , phase_name , bench ) , ) )
+				finally:
+					pool.close()
+					pool.join()
+				print "%-5s %-10s %-7s %10s %10.3f %12s %10.1f %10.1f" % (
+							deploymenttype , "%sx%s" % ( spines , leafs ) , phase['phase'] , phase['configlets'] ,
+							phase['seconds'] , phase['bytes'] , phase['peak_rss_kb'] / 1024.0 , phase['phase_rss_kb'] / 1024.0 )
+				results.append( phase )
+	if bench.output:
+		with open( bench.output , 'w' ) as output_file:
+			json.dump( results , output_file , sort_keys=True , indent=4 )
+
+BENCHMARKS = { 'peering': benchmarkPeering, 'phases': benchmarkPhases }
+
+def main():
+	bp = optparse.OptionParser( usage="usage: %prog [options] " + "|".join( sorted( BENCHMARKS ) ) )
+	bp.add_option( '--sizes', dest='sizes', action='store', help='Comma separated fabric sizes as SPINESxLEAFS', type='string', default='2x4,4x32,16x256,64x2048')
+	bp.add_option( '--types', dest='types', action='store', help='Comma separated deployment types to benchmark', type='string', default='her,cvx,evpn')
+	bp.add_option( '--latency', dest='latency', action='store', help='Simulated CVP round trip in seconds per call', type='float', default=0.05)
+	bp.add_option( '--throughput', dest='throughput', action='store', help='Simulated configlet bytes per second handled by CVP', type='float', default=1000000.0)
+	bp.add_option( '--push-workers', dest='push_workers', action='store', help='Number of configlets pushed concurrently', type='int', default=8)
+	bp.add_option( '--push-queue', dest='push_queue', action='store', help='Number of rendered configlets waiting for a push worker', type='int', default=64)
+	bp.add_option( '--bgp-peering', dest='bgp_peering', action='store', help='Peering mode used by the phases benchmark', type='choice', choices=['explicit','dynamic'], default='explicit')
+	bp.add_option( '--output', dest='output', action='store', help='Also write the phases results as JSON to this file', type='string')
+	bench, args = bp.parse_args()
+	if len( args ) != 1 or args[0] not in BENCHMARKS:
+		bp.error( "choose one benchmark of %s" % ( ", ".join( sorted( BENCHMARKS ) ) ) )
+	BENCHMARKS[ args[0] ]( bench )
+
+if __name__ == "__main__":
+	main()
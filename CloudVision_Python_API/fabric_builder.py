@@ -31,33 +31,159 @@
 # IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import cvp, optparse, json
+import cvp, optparse, json, sys, hashlib, os, re, multiprocessing, copy
+from fabric_push import ConfigletPusher, printErrorReport
+from fabric_journal import PushJournal, journaled
+from fabric_profile import Profiler, ProfiledServer, printReport, writeReport
+from fabric_allocator import AllocatorError, poolPrefixes
+from fabric_model import buildFabric
 from string import Template
 
+try:
+	import yaml
+except ImportError:
+	yaml = None
+
 #
 # Support functions for main code
 #
 
-def configletExists( cvpServer , configlet_name ):
-	configlet_exist = 0
-	myConfiglets = cvpServer.getConfiglets()
-	for myConfiglet in myConfiglets:
-		if myConfiglet.name == configlet_name:
-			configlet_exist = 1
-	return configlet_exist
-
-def updateMyConfiglet( cvpServer , configlet_name , configlet_config ):
+class CvpInventory(object):
+	"""
+	Name keyed snapshot of the configlets and containers on the CVP server.
+
+	The inventory is downloaded once per run. Lookups are dictionary hits and
+	the builder records its own writes in the index, so the server is only
+	listed again when refresh() is called explicitly.
+	"""
+
+	def __init__( self , cvpServer ):
+		self.cvpServer = cvpServer
+		self.configlets = {}
+		self.containers = {}
+		self.digests = {}
+		self.refresh()
+
+	def refresh( self ):
+		self.configlets = {}
+		self.digests = {}
+		for myConfiglet in self.cvpServer.getConfiglets():
+			self.configlets[myConfiglet.name] = myConfiglet
+		self.containers = {}
+		for myContainer in self.cvpServer.getContainers():
+			self.containers[myContainer.name] = myContainer
+
+	def configletExists( self , configlet_name ):
+		return configlet_name in self.configlets
+
+	def containerExists( self , container_name ):
+		return container_name in self.containers
+
+	def configletChanged( self , configlet_name , configlet_config ):
+		"""
+		Compare the content hash of a rendered configlet with the configlet
+		body in the snapshot. Configlets missing from the snapshot, or
+		without a body, count as changed.
+		"""
+		digest = self.digests.get( configlet_name )
+		if digest is None:
+			myConfiglet = self.configlets.get( configlet_name )
+			if myConfiglet is None or getattr( myConfiglet , 'config' , None ) is None:
+				return True
+			digest = configletDigest( myConfiglet.config )
+			self.digests[configlet_name] = digest
+		return digest != configletDigest( configlet_config )
+
+	def configletAdded( self , configlet ):
+		"""
+		Index a configlet the builder pushed. The index keeps its digest and
+		a copy without the body, so it does not hold the text of every
+		configlet of the fabric.
+		"""
+		record = copy.copy( configlet )
+		record.config = None
+		self.configlets[configlet.name] = record
+		self.digests[configlet.name] = configletDigest( configlet.config )
+
+	def containerAdded( self , container ):
+		self.containers[container.name] = container
+
+def configletDigest( configlet_config ):
+	if isinstance( configlet_config , unicode ):
+		configlet_config = configlet_config.encode( 'utf-8' )
+	return hashlib.sha1( configlet_config ).hexdigest()
+
+def addMyConfiglet( cvpServer , inventory , configlet ):
+	cvpServer.addConfiglet( configlet )
+	inventory.configletAdded( configlet )
+
+def updateMyConfiglet( cvpServer , inventory , configlet_name , configlet_config ):
 	myConfiglet = cvpServer.getConfiglet( configlet_name )
 	myConfiglet.config = configlet_config
 	cvpServer.updateConfiglet( myConfiglet )
+	inventory.configletAdded( myConfiglet )
+
+def configletCall( cvpServer , inventory , journal , opts , summary , configlet_name , configlet_config ):
+	"""
+	The call that brings one configlet on CVP up to date: an add when it
+	does not exist yet, otherwise an update. Returns None when there is
+	nothing to do because the journal shows the same content was already
+	pushed or, in incremental mode, the content is unchanged.
+	"""
+	digest = configletDigest( configlet_config )
+	if journal is not None and journal.done( 'configlet' , configlet_name , digest ):
+		summary['journaled'] = summary['journaled'] + 1
+		return None
+	if inventory.configletExists( configlet_name ):
+		if opts.incremental == "yes" and not inventory.configletChanged( configlet_name , configlet_config ):
+			summary['unchanged'] = summary['unchanged'] + 1
+			return None
+		summary['changed'] = summary['changed'] + 1
+		return ( journal , 'configlet' , configlet_name , digest , updateMyConfiglet , cvpServer , inventory , configlet_name , configlet_config )
+	return ( journal , 'configlet' , configlet_name , digest , addMyConfiglet , cvpServer , inventory , cvp.Configlet( configlet_name , configlet_config ) )
+
+def submitConfiglet( cvpServer , inventory , pusher , journal , opts , summary , configlet_name , configlet_config ):
+	"""
+	Queue the configletCall of one configlet on the pusher.
+	"""
+	call = configletCall( cvpServer , inventory , journal , opts , summary , configlet_name , configlet_config )
+	if call is not None:
+		pusher.submit( configlet_name , journaled , *call )
+
+def pushConfiglet( cvpServer , inventory , journal , opts , summary , configlet_name , configlet_config ):
+	"""
+	Execute the configletCall of one configlet right away.
+	"""
+	call = configletCall( cvpServer , inventory , journal , opts , summary , configlet_name , configlet_config )
+	if call is not None:
+		journaled( *call )
+
+def createContainer( cvpServer , inventory , journal , container_name , parent_name ):
+	"""
+	Add a container unless it exists already, returns the container.
+	"""
+	if not inventory.containerExists( container_name ):
+		myContainer = cvp.Container( container_name , parent_name )
+		journaled( journal , 'container' , container_name , None , cvpServer.addContainer , myContainer )
+		inventory.containerAdded( myContainer )
+	return inventory.containers[container_name]
+
+def mapConfiglets( inventory , journal , operation , target_name , function , target , configlet_names ):
+	"""
+	Map configlets, by name, to a container or device with one call of
+	function. Returns False when the journal shows this mapping was done
+	already.
+	"""
+	digest = configletDigest( "\n".join( configlet_names ) )
+	if journal is not None and journal.done( operation , target_name , digest ):
+		return False
+	configlets = [ inventory.configlets[configlet_name] for configlet_name in configlet_names ]
+	journaled( journal , operation , target_name , digest , function , target , configlets )
+	return True
+
+def assignedConfiglets( device ):
+	return set( getattr( configlet , 'name' , configlet ) for configlet in getattr( device , 'configlets' , None ) or [] )
 
-def containerExists( cvpServer , container_name ):
-	container_exist = 0
-	myContainers = cvpServer.getContainers()
-	for myContainer in myContainers:
-		if myContainer.name == container_name:
-			container_exist = 1
-	return container_exist
 #
 # Parse command line options.
 #
@@ -71,19 +197,19 @@ op.add_option( '-n', '--name', dest='dcname', action='store', help='Name of DC t
 op.add_option( '-s', '--spines', dest='spines', action='store', help='Number of spine switches in DC fabric', type='int')
 op.add_option( '-l', '--leafs', dest='leafs', action='store', help='Number of leaf switch MLAG pairs in DC fabric', type='int')
 op.add_option( '-y', '--mlag', dest='mlag', action='store', help='If leafs are MLAG pairs or not', type='string')
-op.add_option( '-w', '--mlagnetwork', dest='mlagnetwork', action='store', help='Network to use for MLAG peer', type='string')
+op.add_option( '-w', '--mlagnetwork', dest='mlagnetwork', action='store', help='Network to use for MLAG peer, the first /31 is used. Example: 192.168.255.0/31', type='string')
 op.add_option( '-q', '--mlagtrunkinterfaces', dest='mlagtrunkinterfaces', action='store', help='The two interfaces to use for MLAG trunk, ex. Ethernet3,Ethernet4', type='string')
 op.add_option( '-d', '--defaultgw', dest='defaultgw', action='store', help='Default gateway for management network', type='string')
-op.add_option( '-m', '--mgmtnetwork', dest='mgmtnet', action='store', help='Management network prefix without last octet. Example: 192.168.0.', type='string')
+op.add_option( '-m', '--mgmtnetwork', dest='mgmtnet', action='store', help='Management address pool, comma separated CIDR prefixes or prefix without last octet. Example: 192.168.0.0/22 or 192.168.0.', type='string')
 op.add_option( '-o', '--mgmtnetmask', dest='mgmtnetmask', action='store', help='Management network netmask in bit length. Example: 24', type='int')
-op.add_option( '-v', '--vxlanloopback', dest='vxlanloopback', action='store', help='Prefix to use for VXLAN loobacks without last octet. Example: 192.168.0.', type='string')
-op.add_option( '-z', '--loopback', dest='loopback', action='store', help='Prefix to use for loobacks without last octet. Example: 192.168.0.', type='string')
-op.add_option( '-x', '--linknetworks', dest='linknetwork', action='store', help='Prefix to use for linknetworks without last octet. Example: 192.168.0.', type='string')
+op.add_option( '-v', '--vxlanloopback', dest='vxlanloopback', action='store', help='Pool to use for VXLAN loobacks, comma separated CIDR prefixes or prefix without last octet. Example: 192.168.0.0/22 or 192.168.0.', type='string')
+op.add_option( '-z', '--loopback', dest='loopback', action='store', help='Pool to use for loobacks, comma separated CIDR prefixes or prefix without last octet. Example: 192.168.0.0/22 or 192.168.0.', type='string')
+op.add_option( '-x', '--linknetworks', dest='linknetwork', action='store', help='Pool to carve /31 linknetworks from, comma separated CIDR prefixes or prefix without last octet. Example: 192.168.0.0/20 or 192.168.0.', type='string')
 op.add_option( '-t', '--type', dest='deploymenttype', action='store', help='Type of deployment, her for ip fabric HER, cvx for ip fabric cvx, evpn for ip fabric EVPN', type='string')
 op.add_option( '-b', '--cvxserver', dest='cvxserver', action='store', help='IP address on CVX server', type='string')
 op.add_option( '-e', '--is-virtual', dest='virtual', action='store', help='If virtual is yes, interface naming will fit vEOS-lab. If virtual is no, interface naming is adaptd to 1RU and 2RU leafs and spines', type='string', default='yes')
 op.add_option( '-f', '--no-uplinks', dest='uplinks', action='store', help='Number of uplinks from leaf to each spine', type='int')
-op.add_option( '-g', '--offset', dest='offset', action='store', help='Which switch number to continue with when building next DC if IP resources are shared.', type='int',default=1)
+op.add_option( '-g', '--offset', dest='offset', action='store', help='Which switch number to continue with when building next DC if IP resources are shared. Not used, build the DCs together with --spec to share IP resources.', type='int',default=1)
 op.add_option( '-i', '--mgmt-ip', dest='mgmtip', action='store', help='Which IP to start on in MGMT subnet', type='int',default=1)
 op.add_option( '-a', '--debug', dest='debug', action='store', help='If debug is yes, nothing will actually be sent to CVP and proposed configs are written to terminal', type='string', default='no')
 op.add_option( '-4', '--syslogserver', dest='syslogserver', action='store', help='IP of syslogserver for logging from switches', type='string')
@@ -95,219 +221,26 @@ op.add_option( '-3', '--log_facility', dest='log_facility', action='store', help
 op.add_option( '-5', '--spine-start-asn', dest='spine_start_asn', action='store', help='Starting ASN for spine which also is offset for the rest of the Datacenter.', type='int')
 op.add_option( '-6', '--max-routes', dest='max_routes', action='store', help='Max routes to announce in underlay.', type='int')
 op.add_option( '-7', '--max-evpn-routes', dest='max_evpn_routes', action='store', help='Max routes to announce in EVPN.', type='int')
-
-opts, _ = op.parse_args()
-
-#
-# Assign command line options to variables and assign static variables.
-#
-
-host = opts.cvphostname
-user = opts.cvpusername
-password = opts.cvppassword
-name = opts.dcname
-no_spine = opts.spines
-no_leaf = opts.leafs
-defaultgw = opts.defaultgw
-mgmtnetwork = opts.mgmtnet
-mgmtnetmask = opts.mgmtnetmask
-vxlanloopback = opts.vxlanloopback
-loopback = opts.loopback
-linknetwork = opts.linknetwork
-deploymenttype = opts.deploymenttype
-cvxserver = opts.cvxserver
-mlag = opts.mlag
-mlagnetwork = opts.mlagnetwork
-mlagtrunkinterfaces = opts.mlagtrunkinterfaces
-debug = opts.debug
-virtual = opts.virtual
-uplinks = opts.uplinks
-syslogserver = opts.syslogserver
-snmp_private = opts.snmp_private
-snmp_public = opts.snmp_public
-log_facility = opts.log_facility
-primary_ntp = opts.primary_ntp
-second_ntp = opts.second_ntp
-spine_start_asn = opts.spine_start_asn
-max_routes = opts.max_routes
-max_evpn_routes = opts.max_evpn_routes
-
-parentName = 'Tenant'
-my_spine_container_name = name + " Spine"
-my_leaf_container_name = name + " Leaf"
-dc_configlet_name = name + " Base config"
-configlet_list = []
-cvx_configlet_list = []
-leaf_configlet_list = []
-max_ecmp = no_spine * uplinks
-
-#
-# The first part of the code builds a dictionary representing first all the spines
-# and their relevant data to create their config.
-#
-# Second part of the code builds a dictionary representing first all the leafs
-# and their relevant data to create their config.
-#
-
-#
-# Build the DC list of spine switches in dictionary form.
-#
-
-linksubnetcounter = 0
-loopbackcounter = 0
-vxlanloopbackcounter = 0
-mgmtnetworkcounter = 1
-
-DC = []
-Leafs = []
-
-for counter in range(1,no_spine+1):
-	spine_name = name + "spine" + str(counter)
-	interface_list = []
-	element_dict = {}
-	element_dict['name'] = spine_name
-	element_dict['loopback'] = loopback + str(loopbackcounter)
-	loopbackcounter = loopbackcounter + 1
-	element_dict['mgmt'] = mgmtnetwork + str(mgmtnetworkcounter)
-	mgmtnetworkcounter = mgmtnetworkcounter + 1
-	counter3 = 1
-
-	for counter2 in range(1,no_leaf+1):
-		for i in range(1,uplinks+1):
-			if virtual == "no":
-				spine_interface_name = "Ethernet"+str(counter3)+"/1"
-			else:
-				spine_interface_name = "Ethernet"+str(counter3)
-
-			leaf_name = name + "leaf" + str(counter2)
-			neighbor_dict = {}
-			neighbor_dict['neighbor'] = leaf_name
-			link = linknetwork + str(linksubnetcounter)
-			neighborlink = linknetwork + str(linksubnetcounter+1)
-			neighborint = str(linksubnetcounter+1)
-			linksubnetcounter = linksubnetcounter + 2
-			neighbor_dict['linknet'] = link
-			neighbor_dict['neighbor_ip'] = neighborlink
-			if virtual == "no":
-				neighbor_dict['neighbor_interface'] = "Ethernet" + str(i + 48 + ((counter - 1) * uplinks)) + "/1"
-			else:
-				neighbor_dict['neighbor_interface'] = "Ethernet" + str(i + ((counter - 1) * uplinks))
-			
-			neighbor_dict['local_interface'] = spine_interface_name
-			neighbor_dict['neighbor_int'] = neighborint
-			
-			neighbor_asn = spine_start_asn + counter2
-			if neighbor_asn % 2 == 1:
-				neighbor_dict['asn'] = neighbor_asn
-			else:
-				neighbor_dict['asn'] = neighbor_asn - 1 
-			
-			interface_list.append(neighbor_dict)
-			counter3 = counter3 + 1
-		
-		element_dict['interfaces'] = interface_list
-	
-	DC.append(element_dict)
-
-#
-# Build the Leaf list of leaf switches in dictionary form.
-#
-
-#
-# If leafs are organised as MLAG pairs, build accordingly.
-#
-
-if mlag == "yes":
-	for counter in range (1,no_leaf+1):
-		leaf_dict = {}
-		leaf_dict['name'] = name + "leaf" + str(counter)
-		leaf_dict['loopback'] = loopback + str(loopbackcounter)
-		loopbackcounter = loopbackcounter +1
-		if vxlanloopbackcounter % 2 == 1:
-			mlaginterface = mlagnetwork + "0"
-			mlagpeer = mlagnetwork + "1"
-			leaf_dict['mlaginterface'] = mlaginterface
-			leaf_dict['mlagpeer'] = mlagpeer
-			leaf_dict['vxlan'] = vxlanloopback + str(vxlanloopbackcounter - 1)
-		else:
-			mlaginterface = mlagnetwork + "1"
-			mlagpeer = mlagnetwork + "0"
-			leaf_dict['mlaginterface'] = mlaginterface
-			leaf_dict['mlagpeer'] = mlagpeer
-			leaf_dict['vxlan'] = vxlanloopback + str(vxlanloopbackcounter)
-		vxlanloopbackcounter = vxlanloopbackcounter +1
-		leaf_dict['mgmt'] = mgmtnetwork + str(mgmtnetworkcounter)
-		mgmtnetworkcounter = mgmtnetworkcounter + 1
-		asn = spine_start_asn + counter
-		if asn % 2 == 1:
-			leaf_dict['asn'] = asn
-		else:
-			leaf_dict['asn'] = asn - 1 
-
-		Leafs.append(leaf_dict)
-#
-# If leafs are organised standalone, build accordingly.
-#
-
-if mlag == "no":
-	for counter in range (1,no_leaf+1):
-		leaf_dict= {}
-		leaf_dict['name'] = name + "leaf" + str(counter)
-		leaf_dict['loopback'] = loopback + str(loopbackcounter)
-		loopbackcounter = loopbackcounter +1
-		leaf_dict['vxlan'] = vxlanloopback + str(vxlanloopbackcounter)
-		vxlanloopbackcounter = vxlanloopbackcounter +1
-		leaf_dict['mgmt'] = mgmtnetwork + str(mgmtnetworkcounter)
-		mgmtnetworkcounter = mgmtnetworkcounter + 1
-		asn = spine_start_asn + counter
-		leaf_dict['asn'] = asn
-
-		Leafs.append(leaf_dict)
-
-#
-# Build a VTEP list for the HER use case.
-#
-
-if deploymenttype == "her":
-	vteplist = ""
-	for leaf in Leafs:
-		if leaf['vxlan'] not in vteplist:
-			vteplist = vteplist + " " + leaf['vxlan']
-
-#
-# If debug is activated, dump the dictionaries that represents the network to stdout 
-#
-
-if debug != "no":
-	print '%s' % ( json.dumps(DC, sort_keys=True, indent=4) )
-	print '!'
-	print '!'
-	print '!'
-	print '%s' % ( json.dumps(Leafs, sort_keys=True, indent=4) )
-
-#
-# Connect and authenticate with CVP server
-#
-
-if debug == "no":
-	server = cvp.Cvp( host )
-	server.authenticate( user , password )
+op.add_option( '--spec', dest='spec', action='store', help='Build every DC described in this JSON or YAML file in one CVP session, see loadSpec', type='string')
+op.add_option( '--bgp-peering', dest='bgp_peering', action='store', help='explicit renders one spine neighbor per leaf uplink, dynamic renders bgp listen ranges on the spines', type='choice', choices=['explicit','dynamic'], default='explicit')
+op.add_option( '--journal', dest='journal', action='store', help='Record completed CVP operations in this file so an interrupted run resumes where it stopped, removed after a successful run', type='string')
+op.add_option( '--profile', dest='profile', action='store', help='Report per phase wall time, CVP calls by type, bytes sent and the slowest calls, and write the report as JSON to this file', type='string')
+op.add_option( '--incremental', dest='incremental', action='store', help='If incremental is yes, a rebuild only updates configlets whose content differs from CVP', type='string', default='no')
+op.add_option( '--render-dir', dest='render_dir', action='store', help='Render all configlets offline into this directory together with a manifest.json, nothing is sent to CVP', type='string')
+op.add_option( '--render-workers', dest='render_workers', action='store', help='Number of processes rendering configlets for --render-dir, defaults to the number of CPUs', type='int')
+op.add_option( '--push-workers', dest='push_workers', action='store', help='Number of configlets pushed to CVP concurrently.', type='int', default=8)
+op.add_option( '--push-queue', dest='push_queue', action='store', help='Number of rendered configlets waiting for a push worker, rendering pauses while the queue is full.', type='int', default=64)
+op.add_option( '--push-retries', dest='push_retries', action='store', help='Number of retries for a failed CVP call.', type='int', default=3)
+op.add_option( '--push-backoff', dest='push_backoff', action='store', help='Seconds to wait before retrying a failed CVP call, doubled for every retry.', type='float', default=1.0)
 
 #
-# Create needed configlets for the new DC
+# Configlet templates. Every fragment is compiled once when the module is
+# imported and the render functions below collect the substituted fragments
+# in a list that is joined once per configlet, so rendering time grows with
+# the size of the output rather than with the square of it.
 #
 
-Replacements = {
-                "defaultgw": defaultgw,
-                "syslog": syslogserver,
-                "private": snmp_private,
-                "public": snmp_public,
-                "facility": log_facility,
-                "primary_ntp": primary_ntp,
-                "second_ntp": second_ntp               
-                }
-
-dc_base_config = Template("""
+DC_BASE_TEMPLATE = Template("""
 !
 transceiver qsfp default-mode 4x10G
 !
@@ -337,146 +270,46 @@ management api http-commands
    protocol http
    cors allowed-origin all
    no shutdown
-""").safe_substitute(Replacements)
-
-if deploymenttype == "evpn":
-	Replacements = {
-    				"dummy":"dummy"
-                }
+""")
 
-	arbgp_config = Template("""
+ARBGP_CONFIG = """
 !
 service routing protocols model multi-agent 
 !
-""").safe_substitute(Replacements)
-	dc_base_config = dc_base_config + arbgp_config
-
-#
-# Build standalone shared configlets for CVX use case
-#
+"""
 
-if deploymenttype == "cvx":
-	Replacements = {
-					"cvxserver": cvxserver
-					}
-
-	cvx_config = Template("""
+CVX_TEMPLATE = Template("""
 !
 management cvx
    no shutdown
    server host $cvxserver
 !
-""").safe_substitute(Replacements)
-
-#
-# Create Vxlan1 configlets based on CVX deployment type.
-#
+""")
 
-if deploymenttype == "cvx":
-	Replacements = { "dummy": "dummy"
-					}
-	vxlan_leaf_config = Template("""
+VXLAN_CVX_CONFIG = """
 interface Vxlan1
    vxlan source-interface Loopback1
    vxlan udp-port 4789
    vxlan controller-client
 !
-""").safe_substitute(Replacements)
-
-#
-# Create Vxlan1 config based on HER deployment type.
-#
+"""
 
-if deploymenttype == "her":
-	Replacements = { "dummy": "dummy",
-					 "vteplist": vteplist
-					}
-	vxlan_leaf_config = Template("""
+VXLAN_HER_TEMPLATE = Template("""
 interface Vxlan1
    vxlan source-interface Loopback1
    vxlan udp-port 4789
    vxlan flood vtep$vteplist
 !
-""").safe_substitute(Replacements)
-
-#
-# Create Vxlan1 config based on EVPN deployment type.
-#
+""")
 
-if deploymenttype == "evpn":
-	Replacements = { "dummy": "dummy"
-					}
-	vxlan_leaf_config = Template("""
+VXLAN_EVPN_CONFIG = """
 interface Vxlan1
    vxlan source-interface Loopback1
    vxlan udp-port 4789
 !
-""").safe_substitute(Replacements)
-
-# If debug is activated, only print config that should have gone into configlets,
-# do not actually create configlets. If debug is not activated, create configlets
-# and add them to CVP.
-#
-
-if debug == "no":
-	dc_configlet = cvp.Configlet( dc_configlet_name , dc_base_config  )
-	if configletExists( server , dc_configlet_name ):
-		updateMyConfiglet( server , dc_configlet_name , dc_base_config )
-		rebuild = 1
-	else:
-		server.addConfiglet( dc_configlet )
-		configlet_list.append( dc_configlet )
-		rebuild = 0
-
-	vxlan_configlet_name = name + " Interface VXLAN1 base configuration"
-	if rebuild == 1:
-		updateMyConfiglet ( server , vxlan_configlet_name , vxlan_leaf_config )
-	else:
-		vxlan_configlet = cvp.Configlet( vxlan_configlet_name, vxlan_leaf_config )
-		server.addConfiglet( vxlan_configlet )#
-
-	if deploymenttype == "cvx":
-		cvx_configlet_name = name + " CVX client configuration"
-		cvx_configlet = cvp.Configlet( cvx_configlet_name, cvx_config )
-		if configletExists( server , cvx_configlet_name ):
-			updateMyConfiglet( server , cvx_configlet_name , cvx_config )
-		else:
-			server.addConfiglet( cvx_configlet )
-			cvx_configlet_list.append( cvx_configlet )
-else:
-	print "Contents of configlet %s:" % ( dc_configlet_name )
-	print "%s" % ( dc_base_config )
-	print "!"
-	print "!"
-	print "!"
-	vxlan_configlet_name = name + " Interface VXLAN1 base configuration"
-	print "Contents of configlet %s:" % ( vxlan_configlet_name )
-	print "%s" % ( vxlan_leaf_config )
-	print "!"
-	print "!"
-	print "!"
-	if deploymenttype == "cvx":
-		cvx_configlet_name = name + " CVX client configuration"
-		print "Contents of configlet %s:" % ( cvx_configlet_name )
-		print "%s" % ( cvx_config )
-		print "!"
-		print "!"
-		print "!"
+"""
 
-#
-# Build base config configlets for spines and add them to CVP.
-# Start with config that is the same in all deployment types.
-#
-
-for spine_switch in DC:
-	Replacements = {
-					"hostname": spine_switch['name'],
-					"loopaddress": spine_switch['loopback'],
-					"mgmtaddress": spine_switch['mgmt'],
-					"mgmtnetmask": mgmtnetmask
-					}
-
-	spine_base_config = Template("""
+SPINE_BASE_TEMPLATE = Template("""
 !
 hostname $hostname
 !
@@ -485,86 +318,25 @@ interface Loopback0
 !
 interface Management1
    ip address $mgmtaddress/$mgmtnetmask
-""").safe_substitute(Replacements)
-	
-	for interface in spine_switch['interfaces']:
-		Replacements = {
-						"local_interface": interface['local_interface'] ,
-						"description": interface['neighbor'],
-						"linknet": interface['linknet']
-						}
-		add_to_spine_config = Template("""
+""")
+
+SPINE_INTERFACE_TEMPLATE = Template("""
 !
 interface $local_interface
    description $description
    no switchport
    ip address $linknet/31
-!""").safe_substitute(Replacements)
-
-		spine_base_config = spine_base_config + add_to_spine_config
-
-	if debug == "no":
-		spine_configlet_name = spine_switch['name'] + " configuration"
-		if rebuild == 1:
-			updateMyConfiglet( server , spine_configlet_name , spine_base_config )
-		else:
-			spine_configlet = cvp.Configlet( spine_configlet_name , spine_base_config )
-			server.addConfiglet( spine_configlet )
-	else:
-		spine_configlet_name = spine_switch['name'] + " configuration"
-		print "Contents of configlet %s:" % ( spine_configlet_name )
-		print "%s" % ( spine_base_config )
-		print "!"
-		print "!"
-		print "!"
-#
-# Create configlets unique for spine in cvx and her deployment types
-# and add them to CVP.
-#
+!""")
 
-	if deploymenttype == "her" or deploymenttype == "cvx":
-		Replacements = {
-						"routerid": spine_switch['loopback'],
-						"linknet": linknetwork + "0/24",
-						"uplinks": uplinks,
-						"asn": spine_start_asn,
-						"max_routes": max_routes,
-						"max_ecmp": max_ecmp
-						}
-
-		spine_bgp_config = Template("""
+SPINE_BGP_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
    neighbor leafs peer-group
    neighbor leafs maximum-routes $max_routes 
-   redistribute connected""").safe_substitute(Replacements)
-
-		for interface in spine_switch['interfaces']:
-			Replacements = {
-							"neighbor": interface['neighbor_ip'],
-							"asn": interface['asn']
-							}
-			add_to_sping_bgp_config = Template("""
-   neighbor $neighbor peer-group leafs
-   neighbor $neighbor remote-as $asn""").safe_substitute(Replacements)
-			spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-#
-# Create config unique for spine in evpn deployment type
-#
-
-	if deploymenttype == "evpn":
-		Replacements = {
-						"routerid": spine_switch['loopback'],
-						"linknet": linknetwork,
-						"uplinks": uplinks,
-						"asn": spine_start_asn,
-						"max_routes": max_routes,
-						"max_evpn_routes": max_evpn_routes,
-						"max_ecmp": max_ecmp
-						}
+   redistribute connected""")
 
-		spine_bgp_config = Template("""
+SPINE_EVPN_BGP_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
@@ -577,133 +349,49 @@ router bgp $asn
    neighbor EVPN update-source Loopback0
    neighbor EVPN ebgp-multihop 4
    neighbor EVPN send-community
-   redistribute connected""").safe_substitute(Replacements)
-
-		for interface in spine_switch['interfaces']:
-			Replacements = {
-							"neighbor": interface['neighbor_ip'],
-							"asn": interface['asn']
-							}
-			add_to_sping_bgp_config = Template("""
+   redistribute connected""")
+
+SPINE_NEIGHBOR_TEMPLATE = Template("""
    neighbor $neighbor peer-group leafs
-   neighbor $neighbor remote-as $asn""").safe_substitute(Replacements)
-			spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-		for leaf in Leafs:
-			Replacements = {
-							"neighbor": leaf['loopback'],
-							"asn": leaf['asn']
-							}
-			add_to_sping_bgp_config = Template("""
+   neighbor $neighbor remote-as $asn""")
+
+EVPN_NEIGHBOR_TEMPLATE = Template("""
    neighbor $neighbor peer-group EVPN
-   neighbor $neighbor remote-as $asn""").safe_substitute(Replacements)
-			spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-		add_to_sping_bgp_config = ("""
-   address-family evpn""")
-		spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-		for leaf in Leafs:
-			Replacements = {
-							"neighbor": leaf['loopback'],
-							"asn": leaf['asn']
-							}
-			add_to_sping_bgp_config = Template("""
-      neighbor $neighbor activate""").safe_substitute(Replacements)
-			spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-		add_to_sping_bgp_config = ("""
-   address-family ipv4""")
-		spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-		for leaf in Leafs:
-			Replacements = {
-							"neighbor": leaf['loopback'],
-							"asn": leaf['asn']
-							}
-			add_to_sping_bgp_config = Template("""
-      no neighbor $neighbor activate""").safe_substitute(Replacements)
-			spine_bgp_config = spine_bgp_config + add_to_sping_bgp_config
-
-
-	if debug == "no":
-		spine_bgp_configlet_name = spine_switch['name'] + " BGP configuration"
-		if rebuild == 1:
-			updateMyConfiglet( server , spine_bgp_configlet_name , spine_bgp_config )
-		else:
-			spine_bgp_configlet = cvp.Configlet( spine_bgp_configlet_name , spine_bgp_config )
-			server.addConfiglet( spine_bgp_configlet )
-	else:
-		spine_bgp_configlet_name = spine_switch['name'] + " BGP configuration"
-		print "Contents of configlet %s:" % ( spine_bgp_configlet_name )
-		print "%s" % ( spine_bgp_config )
-		print "!"
-		print "!"
-		print "!"
+   neighbor $neighbor remote-as $asn""")
 
+EVPN_ACTIVATE_TEMPLATE = Template("""
+      neighbor $neighbor activate""")
 
+EVPN_DEACTIVATE_TEMPLATE = Template("""
+      no neighbor $neighbor activate""")
 
-# Build base config configlets for leafs and add them to CVP.
-# Start with config that is the same in all deployment types.
+#
+# Dynamic peering: the spines accept any leaf from the linknet and loopback
+# pools whose ASN is in the leaf ASN range, so the size of the spine BGP
+# configlet does not depend on the number of leafs.
 #
 
-for leaf in Leafs:
-	if deploymenttype == "her":
-		Replacements = {
-						"hostname": leaf['name'],
-						"loopback": leaf['loopback'],
-						"vxlan": leaf['vxlan'],
-						"mgmtip": leaf['mgmt'],
-						"mgmtnetmask": mgmtnetmask
-						}
-		leaf_config = Template("""
-!
-hostname $hostname
-!
-interface Loopback0
-   ip address $loopback/32
-!
-interface Loopback1
-   ip address $vxlan/32
-!
-interface Management1
-   ip address $mgmtip/$mgmtnetmask
-!
-""").safe_substitute(Replacements)
+SPINE_PEER_FILTER_TEMPLATE = Template("""
+peer-filter LEAF-ASNS
+   10 match as-range $first_asn-$last_asn result accept
+!""")
 
-	if deploymenttype == "cvx":
-		Replacements = {
-						"hostname": leaf['name'],
-						"loopback": leaf['loopback'],
-						"vxlan": leaf['vxlan'],
-						"mgmtip": leaf['mgmt'],
-						"mgmtnetmask": mgmtnetmask
-						}
-		leaf_config = Template("""
-!
-hostname $hostname
-!
-interface Loopback0
-   ip address $loopback/32
-!
-interface Loopback1
-   ip address $vxlan/32
-!
-interface Management1
-   ip address $mgmtip/$mgmtnetmask
-!
-""").safe_substitute(Replacements)
+SPINE_LISTEN_RANGE_TEMPLATE = Template("""
+   bgp listen range $prefix peer-group $peer_group peer-filter LEAF-ASNS""")
 
+SPINE_DYNAMIC_EVPN_ACTIVATE = """
+   address-family evpn
+      neighbor EVPN activate
+   address-family ipv4
+      no neighbor EVPN activate"""
 
-	if deploymenttype == "evpn":
-		Replacements = {
-						"hostname": leaf['name'],
-						"loopback": leaf['loopback'],
-						"mgmtip": leaf['mgmt'],
-						"mgmtnetmask": mgmtnetmask,
-						"vxlan": leaf['vxlan']
-						}
-		leaf_config = Template("""
+ADDRESS_FAMILY_EVPN = """
+   address-family evpn"""
+
+ADDRESS_FAMILY_IPV4 = """
+   address-family ipv4"""
+
+LEAF_BASE_TEMPLATE = Template("""
 !
 hostname $hostname
 !
@@ -716,22 +404,9 @@ interface Loopback1
 interface Management1
    ip address $mgmtip/$mgmtnetmask
 !
-""").safe_substitute(Replacements)		
+""")
 
-#
-# Create MLAG config when leafs are organised as MLAG pairs.
-#
-
-	if mlag == "yes":
-		mlagtrunkinterfacelist = mlagtrunkinterfaces.split(',')
-		mlagtrunkinterface1 = mlagtrunkinterfacelist[0]
-		mlagtrunkinterface2 = mlagtrunkinterfacelist[1]
-		Replacements = { "mlaginterface": leaf['mlaginterface'],
-						 "mlagpeer": leaf['mlagpeer'],
-						 "mlagtrunkinterface1": mlagtrunkinterface1,
-						 "mlagtrunkinterface2": mlagtrunkinterface2
-						}
-		mlag_add_to_leaf_config = Template("""
+MLAG_TEMPLATE = Template("""
 !
 vlan 4094
    name MLAGPEER
@@ -758,44 +433,18 @@ mlag
    peer-link port-channel 2000
    domain-id MLAG
 !
-""").safe_substitute(Replacements)
-		leaf_config = leaf_config + mlag_add_to_leaf_config
+""")
 
-#
-# Create BGP configlets for CVX and HER deployment types.
-# I.e. underlay BGP configlets.
-#
-
-	if (deploymenttype == "her" or deploymenttype == "cvx") and mlag == "no":
-		Replacements = {
-						"routerid": leaf['loopback'],
-						"uplinks": uplinks,
-						"asn": leaf['asn'],
-						"spine_asn": spine_start_asn,
-						"max_ecmp": max_ecmp,
-						"max_routes": max_routes
-						}
-		leaf_bgp_config = Template("""
+LEAF_BGP_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
    neighbor spines peer-group
    neighbor spines remote-as $spine_asn
    neighbor spines maximum-routes $max_routes
-   redistribute connected""").safe_substitute(Replacements)
-
-	if (deploymenttype == "her" or deploymenttype == "cvx") and mlag == "yes":
-		Replacements = {
-						"routerid": leaf['loopback'],
-						"mlagpeer": leaf['mlagpeer'],
-						"uplinks": uplinks,
-						"asn": leaf['asn'],
-						"spine_asn": spine_start_asn,
-						"max_ecmp": max_ecmp,
-						"max_routes": max_routes
+   redistribute connected""")
 
-						}
-		leaf_bgp_config = Template("""
+LEAF_BGP_MLAG_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
@@ -806,24 +455,9 @@ router bgp $asn
    neighbor mlag-neighbor remote-as $asn
    neighbor mlag-neighbor update-source vlan4094
    neighbor $mlagpeer peer-group mlag-neighbor
-   redistribute connected""").safe_substitute(Replacements)
+   redistribute connected""")
 
-#
-# Create BGP configlets for EVPN deployment types.
-# I.e. underlay and EVPN overlay BGP configlets.
-#
-
-	if deploymenttype ==  "evpn" and mlag == "no":
-		Replacements = {
-						"asn": leaf['asn'] ,
-						"routerid": leaf['loopback'],
-						"uplinks": uplinks,
-						"spine_asn": spine_start_asn,
-						"max_ecmp": max_ecmp,
-						"max_routes": max_routes,
-						"max_evpn_routes": max_evpn_routes
-						}
-		leaf_bgp_config = Template("""
+LEAF_EVPN_BGP_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
@@ -835,20 +469,9 @@ router bgp $asn
    neighbor EVPN maximum-routes $max_routes 
    neighbor spines peer-group
    neighbor spines remote-as $spine_asn
-   neighbor spines maximum-routes $max_evpn_routes""").safe_substitute(Replacements)
+   neighbor spines maximum-routes $max_evpn_routes""")
 
-	if deploymenttype ==  "evpn" and mlag == "yes":
-		Replacements = {
-						"asn": leaf['asn'] ,
-						"routerid": leaf['loopback'],
-						"mlagpeer": leaf['mlagpeer'],
-						"uplinks": uplinks,
-						"spine_asn": spine_start_asn,
-						"max_ecmp": max_ecmp,
-						"max_routes": max_routes,
-						"max_evpn_routes": max_evpn_routes
-						}
-		leaf_bgp_config = Template("""
+LEAF_EVPN_BGP_MLAG_TEMPLATE = Template("""
 router bgp $asn
    router-id $routerid
    maximum-paths $max_ecmp ecmp $max_ecmp
@@ -864,144 +487,647 @@ router bgp $asn
    neighbor $mlagpeer peer-group mlag-neighbor
    neighbor spines peer-group
    neighbor spines remote-as $spine_asn
-   neighbor spines maximum-routes $max_routes""").safe_substitute(Replacements)
+   neighbor spines maximum-routes $max_routes""")
 
-#
-# Build interface configlets for each leaf. Add BGP neighbor configuration to
-# BGP configlets.
-#
-
-	for spine_switch in DC:
-		for interface in spine_switch['interfaces']:
-			if interface['neighbor'] == leaf['name']:
-				Replacements = {
-								"interface": interface['neighbor_interface'],
-								"description": spine_switch['name'],
-								"neighbor_ip": interface['neighbor_ip']
-								}
-				add_to_leaf_config = Template("""
+LEAF_INTERFACE_TEMPLATE = Template("""
 !
 interface $interface
    description $description
    no switchport
    ip address $neighbor_ip/31
 !
-""").safe_substitute(Replacements)
-				leaf_config = leaf_config + add_to_leaf_config
+""")
 
-				if deploymenttype == "her" or deploymenttype == "cvx":
-					Replacements = {
-									"neighborip": linknetwork + str(int(interface['neighbor_int']) -1)
-									}
-					add_to_leaf_bgp_config = Template("""
-   neighbor $neighborip peer-group spines""").safe_substitute(Replacements)
-					leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
+LEAF_NEIGHBOR_TEMPLATE = Template("""
+   neighbor $neighborip peer-group spines""")
 
-				if deploymenttype == "evpn":
-					Replacements = {
-									"neighborip": linknetwork + str(int(interface['neighbor_int']) -1)
-					}
-					add_to_leaf_bgp_config = Template("""
-   neighbor $neighborip peer-group spines""").safe_substitute(Replacements)
-					leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-					
-	if deploymenttype == "evpn":
-		for evpnleaf in DC:
-			Replacements = {
-							"loopback": evpnleaf['loopback'],
-							"asn": spine_start_asn
-							}
-			add_to_leaf_bgp_config = Template("""
-   neighbor $loopback peer-group EVPN
-   neighbor $loopback remote-as $asn""").safe_substitute(Replacements)
-			leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-
-	if deploymenttype == "evpn":
-	
-		add_to_leaf_bgp_config = """
-   address-family evpn"""
-		leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-
-	if deploymenttype == "evpn":
-		for evpnleaf in DC:
-			Replacements = {
-							"loopback": evpnleaf['loopback'],
-							"asn": spine_start_asn
-							}
-			add_to_leaf_bgp_config = Template("""
-      neighbor $loopback activate""").safe_substitute(Replacements)
-			leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-
-	if deploymenttype == "evpn":
-		add_to_leaf_bgp_config = """
-   address-family ipv4"""
-		leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-		for evpnleaf in DC:
-			Replacements = {
-							"loopback": evpnleaf['loopback'],
-							"asn": spine_start_asn
-							}
-			add_to_leaf_bgp_config = Template("""
-      no neighbor $loopback activate""").safe_substitute(Replacements)
-			leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
-
-	if deploymenttype == "evpn":
-		add_to_leaf_bgp_config = """
+LEAF_EVPN_REDISTRIBUTE = """
       redistribute connected"""
-		leaf_bgp_config = leaf_bgp_config + add_to_leaf_bgp_config
 
 #
-# If debug is activated, only print config that should have gone into configlets,
-# do not actually create configlets. If debug is not activated, create configlets
-# and add them to CVP.
+# Render functions. Each returns the complete body of one configlet.
+#
+
+def renderDcBaseConfig( opts ):
+	Replacements = {
+					"defaultgw": opts.defaultgw,
+					"syslog": opts.syslogserver,
+					"private": opts.snmp_private,
+					"public": opts.snmp_public,
+					"facility": opts.log_facility,
+					"primary_ntp": opts.primary_ntp,
+					"second_ntp": opts.second_ntp
+					}
+	dc_base_config = DC_BASE_TEMPLATE.safe_substitute(Replacements)
+	if opts.deploymenttype == "evpn":
+		dc_base_config = dc_base_config + ARBGP_CONFIG
+	return dc_base_config
+
+def renderCvxConfig( opts ):
+	return CVX_TEMPLATE.safe_substitute( { "cvxserver": opts.cvxserver } )
+
+def renderVxlanConfig( opts , fabric ):
+	if opts.deploymenttype == "cvx":
+		return VXLAN_CVX_CONFIG
+	if opts.deploymenttype == "her":
+		vteps = []
+		seen = set()
+		for leaf in fabric.leafs:
+			if leaf.vxlan not in seen:
+				seen.add( leaf.vxlan )
+				vteps.append( " " + leaf.vxlan )
+		return VXLAN_HER_TEMPLATE.safe_substitute( { "vteplist": "".join( vteps ) } )
+	if opts.deploymenttype == "evpn":
+		return VXLAN_EVPN_CONFIG
+
+def renderSpineConfig( spine_switch , fabric , opts ):
+	Replacements = {
+					"hostname": spine_switch.name,
+					"loopaddress": spine_switch.loopback,
+					"mgmtaddress": spine_switch.mgmt,
+					"mgmtnetmask": opts.mgmtnetmask
+					}
+	config = [ SPINE_BASE_TEMPLATE.safe_substitute(Replacements) ]
+	for link in spine_switch.links:
+		Replacements = {
+						"local_interface": fabric.spineInterface( link ) ,
+						"description": link.leaf.name,
+						"linknet": link.linknet
+						}
+		config.append( SPINE_INTERFACE_TEMPLATE.safe_substitute(Replacements) )
+	return "".join( config )
+
+#
+# The EVPN neighbor blocks only depend on the set of peers, which is the same
+# for every spine (all leafs) and for every leaf (all spines). They are
+# rendered once per Fabric and kept on it, so they go away with the fabric.
 #
 
-	if debug == "no":
-		leaf_configlet_name = leaf['name'] + " configuration"
-		if rebuild == 1:
-			updateMyConfiglet ( server , leaf_configlet_name , leaf_config )
+def renderEvpnBlocks( peers ):
+	"""
+	Render the EVPN neighbor blocks for ( loopback , asn ) peers.
+
+	Returns a tuple of the neighbor block, the address-family evpn activate
+	block and the address-family ipv4 deactivate block.
+	"""
+	neighbors = []
+	activate = []
+	deactivate = []
+	for loopback, asn in peers:
+		neighbors.append( EVPN_NEIGHBOR_TEMPLATE.safe_substitute( { "neighbor": loopback, "asn": asn } ) )
+		activate.append( EVPN_ACTIVATE_TEMPLATE.safe_substitute( { "neighbor": loopback } ) )
+		deactivate.append( EVPN_DEACTIVATE_TEMPLATE.safe_substitute( { "neighbor": loopback } ) )
+	return ( "".join( neighbors ) , "".join( activate ) , "".join( deactivate ) )
+
+def evpnBlocks( role , fabric , opts ):
+	"""
+	The EVPN neighbor blocks of a spine ( peers are all leafs ) or of a leaf
+	( peers are all spines ), rendered on first use and kept on the fabric.
+	"""
+	blocks = fabric.evpn_blocks.get( role )
+	if blocks is None:
+		if role == 'spine':
+			blocks = renderEvpnBlocks( ( leaf.loopback , leaf.asn ) for leaf in fabric.leafs )
+		else:
+			blocks = renderEvpnBlocks( ( spine.loopback , opts.spine_start_asn ) for spine in fabric.spines )
+		fabric.evpn_blocks[role] = blocks
+	return blocks
+
+def renderSpineBgpConfig( spine_switch , fabric , opts ):
+	Replacements = {
+					"routerid": spine_switch.loopback,
+					"asn": opts.spine_start_asn,
+					"max_routes": opts.max_routes,
+					"max_evpn_routes": opts.max_evpn_routes,
+					"max_ecmp": opts.spines * opts.uplinks
+					}
+	if opts.deploymenttype == "evpn":
+		config = [ SPINE_EVPN_BGP_TEMPLATE.safe_substitute(Replacements) ]
+	else:
+		config = [ SPINE_BGP_TEMPLATE.safe_substitute(Replacements) ]
+
+	if opts.bgp_peering == "dynamic":
+		return renderSpineDynamicBgpConfig( config , fabric , opts )
+
+	for link in spine_switch.links:
+		Replacements = {
+						"neighbor": link.neighbor_ip,
+						"asn": link.leaf.asn
+						}
+		config.append( SPINE_NEIGHBOR_TEMPLATE.safe_substitute(Replacements) )
+
+	if opts.deploymenttype == "evpn":
+		neighbors, activate, deactivate = evpnBlocks( 'spine' , fabric , opts )
+		config.extend( ( neighbors , ADDRESS_FAMILY_EVPN , activate , ADDRESS_FAMILY_IPV4 , deactivate ) )
+
+	return "".join( config )
+
+def renderSpineDynamicBgpConfig( config , fabric , opts ):
+	asns = [ leaf.asn for leaf in fabric.leafs ]
+	config.insert( 0 , SPINE_PEER_FILTER_TEMPLATE.safe_substitute( { "first_asn": min( asns ), "last_asn": max( asns ) } ) )
+	for prefix in poolPrefixes( opts.linknetwork ):
+		config.append( SPINE_LISTEN_RANGE_TEMPLATE.safe_substitute( { "prefix": prefix, "peer_group": "leafs" } ) )
+	if opts.deploymenttype == "evpn":
+		for prefix in poolPrefixes( opts.loopback ):
+			config.append( SPINE_LISTEN_RANGE_TEMPLATE.safe_substitute( { "prefix": prefix, "peer_group": "EVPN" } ) )
+		config.append( SPINE_DYNAMIC_EVPN_ACTIVATE )
+	return "".join( config )
+
+def renderLeafConfig( leaf , fabric , opts ):
+	Replacements = {
+					"hostname": leaf.name,
+					"loopback": leaf.loopback,
+					"vxlan": leaf.vxlan,
+					"mgmtip": leaf.mgmt,
+					"mgmtnetmask": opts.mgmtnetmask
+					}
+	config = [ LEAF_BASE_TEMPLATE.safe_substitute(Replacements) ]
+
+	if opts.mlag == "yes":
+		mlagtrunkinterfacelist = opts.mlagtrunkinterfaces.split(',')
+		Replacements = { "mlaginterface": leaf.mlaginterface,
+						 "mlagpeer": leaf.mlagpeer,
+						 "mlagtrunkinterface1": mlagtrunkinterfacelist[0],
+						 "mlagtrunkinterface2": mlagtrunkinterfacelist[1]
+						}
+		config.append( MLAG_TEMPLATE.safe_substitute(Replacements) )
+
+	for link in leaf.links:
+		Replacements = {
+						"interface": fabric.leafInterface( link ),
+						"description": link.spine.name,
+						"neighbor_ip": link.neighbor_ip
+						}
+		config.append( LEAF_INTERFACE_TEMPLATE.safe_substitute(Replacements) )
+
+	return "".join( config )
+
+def renderLeafBgpConfig( leaf , fabric , opts ):
+	Replacements = {
+					"asn": leaf.asn,
+					"routerid": leaf.loopback,
+					"mlagpeer": leaf.mlagpeer,
+					"spine_asn": opts.spine_start_asn,
+					"max_ecmp": opts.spines * opts.uplinks,
+					"max_routes": opts.max_routes,
+					"max_evpn_routes": opts.max_evpn_routes
+					}
+	if opts.deploymenttype == "evpn":
+		if opts.mlag == "yes":
+			config = [ LEAF_EVPN_BGP_MLAG_TEMPLATE.safe_substitute(Replacements) ]
 		else:
-			leaf_configlet = cvp.Configlet( leaf_configlet_name , leaf_config )
-			server.addConfiglet( leaf_configlet )
-		
-		leaf_bgp_configlet_name = leaf['name'] + " bgp configuration"
-		if rebuild == 1:
-			updateMyConfiglet ( server , leaf_bgp_configlet_name , leaf_bgp_config )
+			config = [ LEAF_EVPN_BGP_TEMPLATE.safe_substitute(Replacements) ]
+	else:
+		if opts.mlag == "yes":
+			config = [ LEAF_BGP_MLAG_TEMPLATE.safe_substitute(Replacements) ]
 		else:
-			leaf_bgp_configlet = cvp.Configlet( leaf_bgp_configlet_name , leaf_bgp_config )
-			server.addConfiglet( leaf_bgp_configlet )		
+			config = [ LEAF_BGP_TEMPLATE.safe_substitute(Replacements) ]
+
+	for link in leaf.links:
+		config.append( LEAF_NEIGHBOR_TEMPLATE.safe_substitute( { "neighborip": link.linknet } ) )
+
+	if opts.deploymenttype == "evpn":
+		neighbors, activate, deactivate = evpnBlocks( 'leaf' , fabric , opts )
+		config.extend( ( neighbors , ADDRESS_FAMILY_EVPN , activate , ADDRESS_FAMILY_IPV4 , deactivate , LEAF_EVPN_REDISTRIBUTE ) )
+
+	return "".join( config )
+
+#
+# Configlets per device, as lists of ( configlet name , target container , config ).
+#
+
+def dcConfiglets( fabric , opts ):
+	configlets = [
+				  ( fabric.name + " Base config" , fabric.name , renderDcBaseConfig( opts ) ),
+				  ( fabric.name + " Interface VXLAN1 base configuration" , fabric.name + " Leaf" , renderVxlanConfig( opts , fabric ) )
+				 ]
+	if opts.deploymenttype == "cvx":
+		configlets.append( ( fabric.name + " CVX client configuration" , fabric.name , renderCvxConfig( opts ) ) )
+	return configlets
+
+def spineConfiglets( spine_switch , fabric , opts ):
+	container_name = fabric.name + " Spine"
+	return [
+			( spine_switch.name + " configuration" , container_name , renderSpineConfig( spine_switch , fabric , opts ) ),
+			( spine_switch.name + " BGP configuration" , container_name , renderSpineBgpConfig( spine_switch , fabric , opts ) )
+		   ]
+
+def leafConfiglets( leaf , fabric , opts ):
+	container_name = fabric.name + " Leaf"
+	return [
+			( leaf.name + " configuration" , container_name , renderLeafConfig( leaf , fabric , opts ) ),
+			( leaf.name + " bgp configuration" , container_name , renderLeafBgpConfig( leaf , fabric , opts ) )
+		   ]
+
+def deviceConfiglets( fabric , opts ):
+	"""
+	Generator of ( device name , configlets ) for every spine and leaf. A
+	device is only rendered when the consumer asks for it.
+	"""
+	for spine_switch in fabric.spines:
+		yield spine_switch.name , spineConfiglets( spine_switch , fabric , opts )
+	for leaf in fabric.leafs:
+		yield leaf.name , leafConfiglets( leaf , fabric , opts )
+
+#
+# Offline rendering to a directory. The fabric is handed to the worker
+# processes through render_state, which is filled in before the pool is
+# created so the forked workers inherit it instead of receiving a pickled
+# copy of the whole model.
+#
+
+render_state = {}
+
+def writeConfiglet( directory , configlet_name , container_name , config ):
+	filename = re.sub( r'[^A-Za-z0-9._-]+' , '_' , configlet_name ) + '.cfg'
+	with open( os.path.join( directory , filename ) , 'w' ) as configlet_file:
+		configlet_file.write( config )
+	return {
+			'name': configlet_name,
+			'container': container_name,
+			'file': filename,
+			'sha1': configletDigest( config ),
+			'size': len( config )
+		   }
+
+def renderDeviceToDirectory( task ):
+	kind, index = task
+	fabric = render_state['fabric']
+	opts = render_state['opts']
+	if kind == 'spine':
+		configlets = spineConfiglets( fabric.spines[index] , fabric , opts )
 	else:
-		leaf_configlet_name = leaf['name'] + " configuration"
-		print "Contents of configlet %s:" % ( leaf_configlet_name )
-		print "%s" % ( leaf_config )
-		print "!"  
-		print "!"
-		print "!"
-		leaf_bgp_configlet_name = leaf['name'] + " bgp configuration"
-		print "Contents of configlet %s:" % ( leaf_bgp_configlet_name )
-		print "%s" % ( leaf_bgp_config )
-		print "!"
-		print "!"
-		print "!"
+		configlets = leafConfiglets( fabric.leafs[index] , fabric , opts )
+	return [ writeConfiglet( opts.render_dir , configlet_name , container_name , config ) for configlet_name, container_name, config in configlets ]
+
+def renderToDirectory( fabric , opts ):
+	"""
+	Render every configlet of the fabric into opts.render_dir using a pool
+	of worker processes, and write manifest.json listing the configlets in
+	push order with their target container, file, SHA-1 and size.
+	"""
+	if not os.path.isdir( opts.render_dir ):
+		os.makedirs( opts.render_dir )
+	manifest = [ writeConfiglet( opts.render_dir , configlet_name , container_name , config ) for configlet_name, container_name, config in dcConfiglets( fabric , opts ) ]
+	tasks = [ ( 'spine' , index ) for index in range( len( fabric.spines ) ) ] + [ ( 'leaf' , index ) for index in range( len( fabric.leafs ) ) ]
+
+	render_state['fabric'] = fabric
+	render_state['opts'] = opts
+	workers = opts.render_workers or multiprocessing.cpu_count()
+	if workers > 1 and len( tasks ) > 1:
+		pool = multiprocessing.Pool( workers )
+		try:
+			chunksize = max( 1 , len( tasks ) // ( workers * 4 ) )
+			for entries in pool.imap( renderDeviceToDirectory , tasks , chunksize ):
+				manifest.extend( entries )
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for task in tasks:
+			manifest.extend( renderDeviceToDirectory( task ) )
+	render_state.clear()
+
+	with open( os.path.join( opts.render_dir , 'manifest.json' ) , 'w' ) as manifest_file:
+		json.dump( { 'dc': fabric.name, 'configlets': manifest } , manifest_file , sort_keys=True , indent=4 )
+	return manifest
 
+def printConfiglet( configlet_name , config ):
+	print "Contents of configlet %s:" % ( configlet_name )
+	print "%s" % ( config )
+	print "!"
+	print "!"
+	print "!"
 
+#
+# Batch mode. A spec file describes several DCs as lists of option values,
+# keyed by the option dest names of the options above (dcname,
+# spines, leafs, loopback, ...):
+#
+# {
+#     "defaults": { "spines": 2, "loopback": "10.1.0.0/20", ... },
+#     "dcs": [ { "dcname": "DC1", "spine_start_asn": 65000 },
+#              { "dcname": "DC2", "spine_start_asn": 65100 } ]
+# }
+#
+# Each DC starts from the command line options, then the defaults, then its
+# own entry. DCs that use the same loopback, VXLAN loopback, linknet or
+# management pool definition allocate from one shared pool, so their
+# addresses do not overlap. A spec ending in .yaml or .yml is read with
+# PyYAML when it is installed.
+#
+# Options of the run as a whole, the CVP connection, debug, render, journal,
+# profile, incremental and push settings, only come from the command line
+# and are rejected in a spec.
+#
+
+RUN_OPTIONS = ( 'cvphostname' , 'cvpusername' , 'cvppassword' , 'debug' , 'spec' , 'journal' , 'profile' , 'incremental' ,
+				'render_dir' , 'render_workers' , 'push_workers' , 'push_queue' , 'push_retries' , 'push_backoff' )
+
+def loadSpec( filename ):
+	with open( filename ) as spec_file:
+		if filename.endswith( ( '.yaml' , '.yml' ) ):
+			if yaml is None:
+				raise ValueError( "PyYAML is needed to read %s" % ( filename ) )
+			spec = yaml.safe_load( spec_file )
+		else:
+			spec = json.load( spec_file )
+	if not isinstance( spec , dict ) or not isinstance( spec.get( 'dcs' ) , list ) or not spec['dcs']:
+		raise ValueError( "%s must contain a non empty list of dcs" % ( filename ) )
+	dcs = []
+	for dc in spec['dcs']:
+		settings = dict( spec.get( 'defaults' ) or {} )
+		settings.update( dc )
+		dcs.append( settings )
+	return dcs
+
+def dcOptions( opts , settings ):
+	"""
+	Copy of the command line options with the settings of one DC applied.
+	Raises ValueError for unknown options and for RUN_OPTIONS.
+	"""
+	dc_opts = optparse.Values( opts.__dict__ )
+	for key, value in settings.items():
+		if not hasattr( opts , key ):
+			raise ValueError( "unknown option %s in spec" % ( key ) )
+		if key in RUN_OPTIONS:
+			raise ValueError( "option %s applies to the whole run, give it on the command line instead of in the spec" % ( key ) )
+		if value is True:
+			value = "yes"
+		elif value is False:
+			value = "no"
+		setattr( dc_opts , key , value )
+	if opts.render_dir:
+		dc_opts.render_dir = os.path.join( opts.render_dir , dc_opts.dcname )
+	return dc_opts
 
 #
-# If debug is not activated, create Container structure for new DC
+# Steps of building one DC. submitDc queues the configlets of a DC on the
+# shared pusher. Once the pusher has been joined provisionDcs builds the
+# container tree and assigns the configlets of all DCs in one phase.
 #
 
-if debug == "no":
-	if rebuild == 0:
-		my_dc_container = cvp.Container( name, parentName )
-		server.addContainer( my_dc_container )
-		server.mapConfigletToContainer( my_dc_container , configlet_list )
-		if deploymenttype == "cvx":
-			server.mapConfigletToContainer( my_dc_container , cvx_configlet_list )
-
-		my_leaf_container = cvp.Container( my_leaf_container_name , name )
-		server.addContainer( my_leaf_container )
-		leaf_configlet_list.append( vxlan_configlet )
-		server.mapConfigletToContainer( my_leaf_container , leaf_configlet_list )
-
-		my_spine_container = cvp.Container( my_spine_container_name , name )
-		server.addContainer( my_spine_container )
+def printDc( fabric , opts ):
+	DC, Leafs = fabric.asDict()
+	print '%s' % ( json.dumps(DC, sort_keys=True, indent=4) )
+	print '!'
+	print '!'
+	print '!'
+	print '%s' % ( json.dumps(Leafs, sort_keys=True, indent=4) )
+	for configlet_name, container_name, config in dcConfiglets( fabric , opts ):
+		printConfiglet( configlet_name , config )
+	for device_name, configlets in deviceConfiglets( fabric , opts ):
+		for configlet_name, container_name, config in configlets:
+			printConfiglet( configlet_name , config )
+
+def submitDc( server , inventory , pusher , journal , profiler , fabric , opts , summary ):
+	"""
+	Add or update the DC level configlets and queue the spine and leaf
+	configlets on the pusher. Returns the state provisionDcs needs.
+
+	A DC whose base configlet exists is a rebuild, unless the journal shows
+	the first build of the DC was started and not completed.
+	"""
+	name = fabric.name
+	dc_configlet_name = name + " Base config"
+	vxlan_configlet_name = name + " Interface VXLAN1 base configuration"
+	cvx_configlet_name = name + " CVX client configuration"
+
+	resuming = journal is not None and journal.done( 'build' , name )
+	if inventory.configletExists( dc_configlet_name ) and not resuming:
+		rebuild = 1
+	else:
+		rebuild = 0
+		if journal is not None and not resuming:
+			journal.record( 'build' , name )
+
+	dc = { 'fabric': fabric, 'opts': opts, 'rebuild': rebuild, 'configlet_list': [ dc_configlet_name ], 'leaf_configlet_list': [ vxlan_configlet_name ], 'cvx_configlet_list': [], 'device_configlets': [] }
+
+	with profiler.phase( 'render' ):
+		dc_base_config = renderDcBaseConfig( opts )
+		vxlan_leaf_config = renderVxlanConfig( opts , fabric )
+		if opts.deploymenttype == "cvx":
+			cvx_config = renderCvxConfig( opts )
+
+	pushConfiglet( server , inventory , journal , opts , summary , dc_configlet_name , dc_base_config )
+	pushConfiglet( server , inventory , journal , opts , summary , vxlan_configlet_name , vxlan_leaf_config )
+	if opts.deploymenttype == "cvx":
+		pushConfiglet( server , inventory , journal , opts , summary , cvx_configlet_name , cvx_config )
+		dc['cvx_configlet_list'].append( cvx_configlet_name )
+
+	#
+	# The devices are rendered one at a time while the push workers upload
+	# what was rendered before. The pusher queue is bounded, so submit
+	# blocks, and rendering pauses, when the workers fall behind.
+	#
+
+	devices = deviceConfiglets( fabric , opts )
+	while True:
+		with profiler.phase( 'render' ):
+			device = next( devices , None )
+		if device is None:
+			break
+		device_name, configlets = device
+		for configlet_name, container_name, config in configlets:
+			submitConfiglet( server , inventory , pusher , journal , opts , summary , configlet_name , config )
+		dc['device_configlets'].append( ( device_name , [ configlet[0] for configlet in configlets ] ) )
+
+	return dc
+
+def provisioningPlan( dcs ):
+	"""
+	The container tree and configlet assignments of all DCs as
+
+	containers - ( container , parent ) for every container, parents first
+	container_configlets - ( container , configlet names , first build ) to map
+	device_configlets - ( device hostname , configlet names ) to map
+
+	Every container is part of the plan, containers that exist are skipped
+	by createContainer, so a first build that failed half way gets its
+	missing containers on the next run. A container gets its configlets
+	mapped on the first build of the DC or when it was created in this run.
+	"""
+	containers = []
+	container_configlets = []
+	device_configlets = []
+	for dc in dcs:
+		name = dc['fabric'].name
+		containers.extend( [ ( name , 'Tenant' ) , ( name + " Leaf" , name ) , ( name + " Spine" , name ) ] )
+		container_configlets.append( ( name , dc['configlet_list'] + dc['cvx_configlet_list'] , dc['rebuild'] == 0 ) )
+		container_configlets.append( ( name + " Leaf" , dc['leaf_configlet_list'] , dc['rebuild'] == 0 ) )
+		device_configlets.extend( dc['device_configlets'] )
+	return containers, container_configlets, device_configlets
+
+def provisionDcs( server , inventory , journal , dcs ):
+	"""
+	Build the container tree and map the configlets to containers and
+	devices for all DCs in one phase. The cvp module has no call that
+	takes several containers or devices, so this makes one addContainer
+	call per missing container, one mapping call per container and per
+	device with all of its configlets, and one getDevices call to find the
+	registered devices by hostname. Devices that already have all their
+	configlets, mappings the journal shows as done and configlets that
+	failed to push are skipped. Ends with one consolidated task list.
+	"""
+	containers, container_configlets, device_configlets = provisioningPlan( dcs )
+	created = []
+	tasks = []
+	skipped = []
+	unregistered = 0
+
+	for container_name, parent_name in containers:
+		if not inventory.containerExists( container_name ):
+			created.append( container_name )
+		createContainer( server , inventory , journal , container_name , parent_name )
+
+	for container_name, configlet_names, first_build in container_configlets:
+		if not first_build and container_name not in created:
+			continue
+		if [ configlet_name for configlet_name in configlet_names if not inventory.configletExists( configlet_name ) ]:
+			skipped.append( container_name )
+			continue
+		if mapConfiglets( inventory , journal , 'map' , container_name , server.mapConfigletToContainer , inventory.containers[container_name] , configlet_names ):
+			tasks.append( ( 'container' , container_name , configlet_names ) )
+
+	if device_configlets:
+		devices = {}
+		for device in server.getDevices():
+			devices[ device.fqdn.split( '.' )[0] ] = device
+		for device_name, configlet_names in device_configlets:
+			device = devices.get( device_name )
+			if device is None:
+				unregistered = unregistered + 1
+				continue
+			if [ configlet_name for configlet_name in configlet_names if not inventory.configletExists( configlet_name ) ]:
+				skipped.append( device_name )
+				continue
+			if set( configlet_names ) <= assignedConfiglets( device ):
+				continue
+			if mapConfiglets( inventory , journal , 'map-device' , device_name , server.mapConfigletToDevice , device , configlet_names ):
+				tasks.append( ( 'device' , device_name , configlet_names ) )
+
+	printTaskList( len( created ) , tasks , skipped , unregistered )
+
+def printTaskList( created , tasks , skipped , unregistered ):
+	if not created and not tasks and not skipped and not unregistered:
+		return
+	print "Provisioning: %s container(s) created, %s configlet assignment(s)" % ( created , len( tasks ) )
+	for kind, target_name, configlet_names in tasks:
+		print "   %s %s: %s" % ( kind , target_name , ", ".join( configlet_names ) )
+	if skipped:
+		print "Not assigned, configlets failed to push: %s" % ( ", ".join( skipped ) )
+	if unregistered:
+		print "%s device(s) not registered in CVP, their configlets are assigned by a later run" % ( unregistered )
+
+def finishProfile( profiler , opts ):
+	if opts.profile:
+		report = profiler.report()
+		printReport( report )
+		writeReport( report , opts.profile )
+
+def main():
+	opts, _ = op.parse_args()
+	profiler = Profiler()
+
+	#
+	# The DCs to build: the one described by the command line options, or
+	# every DC of the spec file.
+	#
+
+	if opts.spec:
+		try:
+			dc_opts_list = [ dcOptions( opts , settings ) for settings in loadSpec( opts.spec ) ]
+		except ( IOError , ValueError ) as e:
+			op.error( str( e ) )
+	else:
+		dc_opts_list = [ opts ]
+
+	#
+	# Build the model of every DC: spines, leafs and the links between them.
+	#
+
+	pools = {}
+	fabrics = []
+	with profiler.phase( 'model' ):
+		for dc_opts in dc_opts_list:
+			try:
+				fabrics.append( ( buildFabric( dc_opts , pools ) , dc_opts ) )
+			except AllocatorError as e:
+				op.error( "%s: %s" % ( dc_opts.dcname , e ) )
+
+	#
+	# In offline mode render everything to the directory and stop here.
+	#
+
+	if opts.render_dir:
+		for fabric, dc_opts in fabrics:
+			with profiler.phase( 'render' ):
+				manifest = renderToDirectory( fabric , dc_opts )
+			print "Rendered %s configlets, %s bytes, to %s" % ( len( manifest ) , sum( entry['size'] for entry in manifest ) , dc_opts.render_dir )
+		finishProfile( profiler , opts )
+		return
+
+	#
+	# If debug is activated, only print the dictionaries that represents the
+	# network and the config that should have gone into configlets.
+	#
+
+	if opts.debug != "no":
+		with profiler.phase( 'render' ):
+			for fabric, dc_opts in fabrics:
+				printDc( fabric , dc_opts )
+		finishProfile( profiler , opts )
+		return
+
+	#
+	# Connect and authenticate with CVP server once, every DC shares the
+	# session, the inventory snapshot and the push workers.
+	#
+
+	with profiler.phase( 'connect' ):
+		server = cvp.Cvp( opts.cvphostname )
+		if opts.profile:
+			server = ProfiledServer( server , profiler )
+		server.authenticate( opts.cvpusername , opts.cvppassword )
+		inventory = CvpInventory( server )
+	pusher = ConfigletPusher( opts.push_workers , opts.push_retries , opts.push_backoff , opts.push_queue )
+	summary = { 'changed': 0, 'unchanged': 0, 'journaled': 0 }
+	journal = None
+	if opts.journal:
+		journal = PushJournal( opts.journal )
+
+	with profiler.phase( 'submit' ):
+		dcs = [ submitDc( server , inventory , pusher , journal , profiler , fabric , dc_opts , summary ) for fabric, dc_opts in fabrics ]
+
+	#
+	# Wait for the push workers to finish before the containers are built.
+	#
+
+	with profiler.phase( 'push wait' ):
+		push_errors = pusher.join()
+		pusher.close()
+	if push_errors:
+		printErrorReport( push_errors )
+	if opts.incremental == "yes" and [ dc for dc in dcs if dc['rebuild'] == 1 ]:
+		print "Incremental rebuild: %s configlet(s) changed, %s unchanged" % ( summary['changed'] , summary['unchanged'] )
+
+	if summary['journaled']:
+		print "Resumed from journal: %s configlet(s) already pushed" % ( summary['journaled'] )
+
+	with profiler.phase( 'provision' ):
+		provisionDcs( server , inventory , journal , dcs )
+
+	if journal is not None:
+		if push_errors:
+			journal.close()
+			print "Journal kept in %s, run again to resume" % ( opts.journal )
+		else:
+			journal.remove()
+
+	finishProfile( profiler , opts )
+
+	if push_errors:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+'''
+   Write-ahead journal used by fabric_builder.py to resume interrupted pushes.
+
+   Every CVP operation that completes is appended to the journal as one
+   JSON line and synced to disk before the next is recorded. An operation
+   is identified by its kind, the name of the configlet or container and,
+   for configlets, the SHA-1 of the pushed content, so a re-run skips the
+   operations that already completed with the same content and redoes the
+   rest. The journal is removed once a run completes without errors.
+'''
+
+import json, os, threading
+
+class PushJournal(object):
+	"""
+	Append only record of completed CVP operations.
+
+	Variables:
+	self.filename - path of the journal file
+	self.completed - set of ( operation , name , digest ) already recorded
+
+	Functions:
+	done - if an operation completed in this or an earlier run
+	record - append a completed operation and sync it to disk
+	remove - delete the journal after a successful run
+	"""
+
+	def __init__( self , filename ):
+		self.filename = filename
+		self.completed = set()
+		self.lock = threading.Lock()
+		if os.path.exists( filename ):
+			with open( filename , 'r+b' ) as journal_file:
+				content = journal_file.read()
+				#
+				# The last line is torn if the previous run died while
+				# writing it. Cut it off so the next record starts on a
+				# line of its own.
+				#
+				if content and not content.endswith( '\n' ):
+					content = content[ : content.rfind( '\n' ) + 1 ]
+					journal_file.truncate( len( content ) )
+			for line in content.splitlines():
+				try:
+					entry = json.loads( line )
+				except ValueError:
+					continue
+				self.completed.add( ( entry['op'] , entry['name'] , entry.get( 'sha1' ) ) )
+		self.journal_file = open( filename , 'a' )
+
+	def done( self , operation , name , digest=None ):
+		return ( operation , name , digest ) in self.completed
+
+	def record( self , operation , name , digest=None ):
+		line = json.dumps( { 'op': operation, 'name': name, 'sha1': digest } , sort_keys=True )
+		with self.lock:
+			self.journal_file.write( line + '\n' )
+			self.journal_file.flush()
+			os.fsync( self.journal_file.fileno() )
+			self.completed.add( ( operation , name , digest ) )
+
+	def close( self ):
+		self.journal_file.close()
+
+	def remove( self ):
+		self.close()
+		os.remove( self.filename )
+
+def journaled( journal , operation , name , digest , function , *args ):
+	"""
+	Call function and record the operation in the journal once it returned.
+	Without a journal this is a plain call.
+	"""
+	result = function( *args )
+	if journal is not None:
+		journal.record( operation , name , digest )
+	return result
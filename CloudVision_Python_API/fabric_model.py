@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+'''
+   Topology model used by fabric_builder.py.
+
+   A fabric is a list of Spine and Leaf records and one Link record per
+   spine to leaf uplink. The records use __slots__ and links keep their
+   addresses as integers and their interfaces as numbers, the dotted
+   addresses and interface names are formatted when a configlet is
+   rendered. This keeps large spine x leaf x uplink fabrics small in
+   memory and cheap to iterate.
+'''
+
+from fabric_allocator import AddressPool, int2ip, leafAsn
+
+class Spine(object):
+	__slots__ = ( 'number' , 'name' , 'loopback' , 'mgmt' , 'links' )
+
+	def __init__( self , number , name , loopback , mgmt ):
+		self.number = number
+		self.name = name
+		self.loopback = loopback
+		self.mgmt = mgmt
+		self.links = []
+
+class Leaf(object):
+	__slots__ = ( 'number' , 'name' , 'loopback' , 'vxlan' , 'mgmt' , 'asn' , 'mlaginterface' , 'mlagpeer' , 'links' )
+
+	def __init__( self , number , name , loopback , vxlan , mgmt , asn , mlaginterface=None , mlagpeer=None ):
+		self.number = number
+		self.name = name
+		self.loopback = loopback
+		self.vxlan = vxlan
+		self.mgmt = mgmt
+		self.asn = asn
+		self.mlaginterface = mlaginterface
+		self.mlagpeer = mlagpeer
+		self.links = []
+
+class Link(object):
+	"""
+	One uplink between a spine and a leaf.
+
+	Variables:
+	self.spine - the Spine record
+	self.leaf - the Leaf record
+	self.uplink - number of the uplink between this spine and leaf, from 1
+	self.address - integer base address of the /31, the spine uses the
+	first address and the leaf the second
+	"""
+
+	__slots__ = ( 'spine' , 'leaf' , 'uplink' , 'address' )
+
+	def __init__( self , spine , leaf , uplink , address ):
+		self.spine = spine
+		self.leaf = leaf
+		self.uplink = uplink
+		self.address = address
+
+	@property
+	def linknet( self ):
+		return int2ip( self.address )
+
+	@property
+	def neighbor_ip( self ):
+		return int2ip( self.address + 1 )
+
+class Fabric(object):
+	"""
+	Spines, leafs and links of one DC.
+
+	Variables:
+	self.evpn_blocks - rendered EVPN neighbor blocks, keyed by the role of
+	the devices using them, filled in by fabric_builder.evpnBlocks
+
+	Functions:
+	spineInterface - name of the spine interface of a link
+	leafInterface - name of the leaf interface of a link
+	asDict - the fabric as the DC and Leafs lists of dictionaries used by the debug output
+	"""
+
+	__slots__ = ( 'name' , 'virtual' , 'uplinks' , 'spines' , 'leafs' , 'links' , 'evpn_blocks' )
+
+	def __init__( self , name , virtual , uplinks ):
+		self.name = name
+		self.virtual = virtual
+		self.uplinks = uplinks
+		self.spines = []
+		self.leafs = []
+		self.links = []
+		self.evpn_blocks = {}
+
+	def spineInterface( self , link ):
+		number = ( link.leaf.number - 1 ) * self.uplinks + link.uplink
+		if self.virtual == "no":
+			return "Ethernet%s/1" % ( number )
+		return "Ethernet%s" % ( number )
+
+	def leafInterface( self , link ):
+		number = link.uplink + ( link.spine.number - 1 ) * self.uplinks
+		if self.virtual == "no":
+			return "Ethernet%s/1" % ( number + 48 )
+		return "Ethernet%s" % ( number )
+
+	def asDict( self ):
+		DC = []
+		for spine in self.spines:
+			interfaces = []
+			for link in spine.links:
+				interfaces.append( {
+									'neighbor': link.leaf.name,
+									'linknet': link.linknet,
+									'neighbor_ip': link.neighbor_ip,
+									'neighbor_interface': self.leafInterface( link ),
+									'local_interface': self.spineInterface( link ),
+									'asn': link.leaf.asn
+									} )
+			DC.append( { 'name': spine.name, 'loopback': spine.loopback, 'mgmt': spine.mgmt, 'interfaces': interfaces } )
+		Leafs = []
+		for leaf in self.leafs:
+			leaf_dict = { 'name': leaf.name, 'loopback': leaf.loopback, 'vxlan': leaf.vxlan, 'mgmt': leaf.mgmt, 'asn': leaf.asn }
+			if leaf.mlaginterface is not None:
+				leaf_dict['mlaginterface'] = leaf.mlaginterface
+				leaf_dict['mlagpeer'] = leaf.mlagpeer
+			Leafs.append( leaf_dict )
+		return DC, Leafs
+
+def sharedPool( pools , role , pool , start=0 ):
+	"""
+	The AddressPool for a role and pool definition. DCs built with the same
+	pools dictionary and the same definition for a role continue allocating
+	from the same AddressPool instead of starting over.
+	"""
+	if pools is None:
+		return AddressPool( pool , start )
+	key = ( role , pool )
+	if key not in pools:
+		pools[key] = AddressPool( pool , start )
+	return pools[key]
+
+def buildFabric( opts , pools=None ):
+	"""
+	Build the Fabric of the DC described by the command line options.
+	Pass the same pools dictionary when building several DCs to share
+	address pools between them, see sharedPool.
+
+	Raises fabric_allocator.AllocatorError when an address pool is invalid
+	or too small for the fabric.
+	"""
+	loopback_pool = sharedPool( pools , 'loopback' , opts.loopback )
+	vxlan_pool = sharedPool( pools , 'vxlan' , opts.vxlanloopback )
+	link_pool = sharedPool( pools , 'link' , opts.linknetwork )
+	mgmt_pool = sharedPool( pools , 'mgmt' , opts.mgmtnet , opts.mgmtip )
+	if opts.mlag == "yes":
+		mlag_base = AddressPool( opts.mlagnetwork ).first()
+
+	fabric = Fabric( opts.dcname , opts.virtual , opts.uplinks )
+
+	for counter in range( 1 , opts.spines + 1 ):
+		spine = Spine( counter , opts.dcname + "spine" + str( counter ) , loopback_pool.address() , mgmt_pool.address() )
+		fabric.spines.append( spine )
+
+	#
+	# Leaf loopbacks follow the spine loopbacks in the same pool. Both leafs
+	# of an MLAG pair share the VXLAN loopback, which is the first address
+	# of a /31 allocated for the pair.
+	#
+
+	for counter in range( 1 , opts.leafs + 1 ):
+		name = opts.dcname + "leaf" + str( counter )
+		loopback = loopback_pool.address()
+		mgmt = mgmt_pool.address()
+		asn = leafAsn( opts.spine_start_asn , counter , opts.mlag )
+		if opts.mlag == "yes":
+			if counter % 2 == 1:
+				vxlan = int2ip( vxlan_pool.allocate( 2 ) )
+				leaf = Leaf( counter , name , loopback , vxlan , mgmt , asn , int2ip( mlag_base + 1 ) , int2ip( mlag_base ) )
+			else:
+				leaf = Leaf( counter , name , loopback , vxlan , mgmt , asn , int2ip( mlag_base ) , int2ip( mlag_base + 1 ) )
+		else:
+			leaf = Leaf( counter , name , loopback , vxlan_pool.address() , mgmt , asn )
+		fabric.leafs.append( leaf )
+
+	for spine in fabric.spines:
+		for leaf in fabric.leafs:
+			for uplink in range( 1 , opts.uplinks + 1 ):
+				link = Link( spine , leaf , uplink , link_pool.allocate( 2 ) )
+				fabric.links.append( link )
+				spine.links.append( link )
+				leaf.links.append( link )
+
+	return fabric
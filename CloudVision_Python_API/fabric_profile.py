@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+
+'''
+   Opt-in instrumentation for fabric_builder.py --profile.
+
+   Profiler collects the wall time of the phases of a run and, through
+   ProfiledServer, the number, duration and payload bytes of the CVP calls
+   by method, and the slowest individual calls. The report is printed at
+   the end of the run and written as JSON so runs can be compared.
+'''
+
+import heapq, json, threading, time
+from contextlib import contextmanager
+
+class Profiler(object):
+	"""
+	Phase timers and CVP call statistics of one run.
+
+	Variables:
+	self.phases - list of phase names in the order they were first entered
+	self.phase_stats - phase name to [ seconds , times entered ]
+	self.calls - CVP method name to [ count , seconds , bytes , errors ]
+	self.slowest - heap of the self.keep slowest calls as ( seconds , method , target )
+
+	Functions:
+	phase - context manager timing a phase, repeated phases add up
+	recordCall - account one CVP call, used by ProfiledServer
+	report - the statistics as a dictionary
+	"""
+
+	def __init__( self , keep=10 ):
+		self.start = time.time()
+		self.keep = keep
+		self.phases = []
+		self.phase_stats = {}
+		self.calls = {}
+		self.slowest = []
+		self.lock = threading.Lock()
+
+	@contextmanager
+	def phase( self , name ):
+		start = time.time()
+		try:
+			yield
+		finally:
+			elapsed = time.time() - start
+			if name not in self.phase_stats:
+				self.phases.append( name )
+				self.phase_stats[name] = [ 0.0 , 0 ]
+			self.phase_stats[name][0] += elapsed
+			self.phase_stats[name][1] += 1
+
+	def recordCall( self , method , target , seconds , payload , failed ):
+		with self.lock:
+			stats = self.calls.setdefault( method , [ 0 , 0.0 , 0 , 0 ] )
+			stats[0] += 1
+			stats[1] += seconds
+			stats[2] += payload
+			if failed:
+				stats[3] += 1
+			entry = ( seconds , method , target )
+			if len( self.slowest ) < self.keep:
+				heapq.heappush( self.slowest , entry )
+			elif entry > self.slowest[0]:
+				heapq.heapreplace( self.slowest , entry )
+
+	def report( self ):
+		with self.lock:
+			return {
+					'total_seconds': time.time() - self.start,
+					'phases': [ { 'name': name, 'seconds': self.phase_stats[name][0], 'count': self.phase_stats[name][1] } for name in self.phases ],
+					'calls': dict( ( method , { 'count': stats[0], 'seconds': stats[1], 'bytes': stats[2], 'errors': stats[3] } ) for method, stats in self.calls.items() ),
+					'slowest': [ { 'seconds': seconds, 'call': method, 'target': target } for seconds, method, target in sorted( self.slowest , reverse=True ) ]
+				   }
+
+def payloadBytes( args ):
+	"""
+	Approximate request size of a call: configlet bodies and string
+	arguments, and the names of configlets passed in lists.
+	"""
+	size = 0
+	for arg in args:
+		if isinstance( arg , basestring ):
+			size += len( arg )
+		elif isinstance( arg , list ):
+			size += payloadBytes( [ getattr( item , 'name' , item ) for item in arg ] )
+		elif isinstance( getattr( arg , 'config' , None ) , basestring ):
+			size += len( arg.config )
+	return size
+
+class ProfiledServer(object):
+	"""
+	Proxy for a cvp.Cvp object that times every method call and accounts it
+	with the profiler. Attributes that are not methods are passed through.
+	The arguments of the CREDENTIAL_CALLS are neither used as the target of
+	the call nor counted in the bytes sent, so credentials never end up in
+	the report.
+	"""
+
+	CREDENTIAL_CALLS = ( 'authenticate' , )
+
+	def __init__( self , server , profiler ):
+		self.server = server
+		self.profiler = profiler
+
+	def __getattr__( self , name ):
+		attribute = getattr( self.server , name )
+		if not callable( attribute ):
+			return attribute
+		profiler = self.profiler
+
+		def profiledCall( *args , **kwargs ):
+			target = None
+			size = 0
+			if args and name not in self.CREDENTIAL_CALLS:
+				target = getattr( args[0] , 'name' , None ) or getattr( args[0] , 'fqdn' , None )
+				if target is None and isinstance( args[0] , basestring ):
+					target = args[0]
+				size = payloadBytes( args )
+			start = time.time()
+			failed = True
+			try:
+				result = attribute( *args , **kwargs )
+				failed = False
+				return result
+			finally:
+				profiler.recordCall( name , target , time.time() - start , size , failed )
+		return profiledCall
+
+def printReport( report ):
+	print "Profile: %.3f seconds" % ( report['total_seconds'] )
+	for phase in report['phases']:
+		print "   phase %-12s %10.3f s" % ( phase['name'] , phase['seconds'] )
+	for method in sorted( report['calls'] ):
+		stats = report['calls'][method]
+		print "   call  %-24s %6s calls %10.3f s %12s bytes %4s errors" % ( method , stats['count'] , stats['seconds'] , stats['bytes'] , stats['errors'] )
+	for call in report['slowest']:
+		print "   slow  %-24s %10.3f s %s" % ( call['call'] , call['seconds'] , call['target'] or '' )
+
+def writeReport( report , filename ):
+	with open( filename , 'w' ) as report_file:
+		json.dump( report , report_file , sort_keys=True , indent=4 )
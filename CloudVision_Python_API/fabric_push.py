@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, Arista Networks, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#   Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+#
+#   Neither the name of Arista Networks nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL ARISTA NETWORKS
+# BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+# WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN
+# IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+'''
+   Worker pool used by fabric_builder.py to push configlets to CVP.
+
+   Each CVP call is dominated by the round trip to the server, so the
+   builder submits its addConfiglet/updateConfiglet calls here and a
+   bounded number of threads execute them concurrently. The queue between
+   the builder and the threads is bounded as well, submit blocks while it
+   is full, so only a limited number of rendered configlets wait in
+   memory. Failed calls are retried with exponential backoff and errors
+   are reported in the order the calls were submitted.
+'''
+
+import Queue, threading, time
+
+class ConfigletPusher(object):
+	"""
+	Execute CVP calls on a fixed number of worker threads.
+
+	Variables:
+	self.workers - number of concurrent calls towards CVP
+	self.retries - number of retries for a failed call before giving up
+	self.backoff - seconds to wait before the first retry, doubled for every retry
+	self.queue_size - number of calls waiting for a worker before submit blocks, 0 for unbounded
+	self.errors - list of (sequence, description, error) for calls that failed
+
+	Functions:
+	submit - queue a call, blocks while the queue is full
+	join - wait for all queued calls and return the ordered error report
+	close - stop the worker threads
+	"""
+
+	def __init__( self , workers=8 , retries=3 , backoff=1.0 , queue_size=0 ):
+		self.workers = max( 1 , workers )
+		self.retries = max( 0 , retries )
+		self.backoff = backoff
+		self.queue_size = max( 0 , queue_size )
+		self.errors = []
+		self.sequence = 0
+		self.queue = Queue.Queue( self.queue_size )
+		self.lock = threading.Lock()
+		self.threads = []
+		for counter in range( self.workers ):
+			thread = threading.Thread( target=self._worker )
+			thread.daemon = True
+			thread.start()
+			self.threads.append( thread )
+
+	def submit( self , description , function , *args ):
+		self.sequence = self.sequence + 1
+		self.queue.put( ( self.sequence , description , function , args ) )
+
+	def _worker( self ):
+		while True:
+			job = self.queue.get()
+			if job is None:
+				self.queue.task_done()
+				return
+			sequence, description, function, args = job
+			for attempt in range( self.retries + 1 ):
+				try:
+					function( *args )
+					break
+				except Exception as e:
+					if attempt == self.retries:
+						with self.lock:
+							self.errors.append( ( sequence , description , str( e ) ) )
+					else:
+						time.sleep( self.backoff * ( 2 ** attempt ) )
+			self.queue.task_done()
+
+	def join( self ):
+		self.queue.join()
+		return sorted( self.errors )
+
+	def close( self ):
+		for thread in self.threads:
+			self.queue.put( None )
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+def printErrorReport( errors ):
+	"""
+	Print the ordered error report returned by ConfigletPusher.join()
+	"""
+	print "%s CVP call(s) failed:" % ( len( errors ) )
+	for sequence, description, error in errors:
+		print "   #%s %s: %s" % ( sequence , description , error )
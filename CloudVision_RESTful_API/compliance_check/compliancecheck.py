@@ -38,8 +38,8 @@ __author__ = 'jkelly@arista.com'
    and then email and/or syslog a list of devices found to be out of compliance.
 
    Description:
-   Run every X interval
-   Call compliance check from root container
+   Keep a schedule of the next check time of every device, refresh the device list every X interval
+   Probe the devices that are due concurrently: reachability test, then compliance check of the reachable ones
    Generate list of non-compliant systems
    If configured, email list
    If configured, iterate list and SYSLOG to configured server
@@ -49,6 +49,19 @@ __author__ = 'jkelly@arista.com'
    Username / Password must be inside script/script configuration or specified on command line
    Tested with GMAIL only - Email username and password (app specific) need to be set for gmail
    X interval should be configurable with comment discouraging setting this to low
+   Probes run on PROBE_WORKERS threads and every call of a probe gets PROBE_TIMEOUT seconds, so one slow
+   device does not stall the cycle. A device that fails the reachability test is reported unreachable,
+   a device whose probe fails or times out on the CVP side is not reported and keeps its last status
+   A device that stays in compliance is checked less and less often, up to MAX_INTERVAL seconds apart.
+   A device that changed state or is unreachable is checked again after RECHECK_INTERVAL seconds.
+   Check times are jittered so the checks are spread out instead of hitting CVP all at once
+   The last status of every device is kept in STATEFILE, keyed by mac address, so a restart only
+   reports devices whose status changed while the daemon was down
+   Notifications are queued to a notifier thread, a slow mail or syslog server never delays a check.
+   It keeps its syslog handlers and SMTP connection open, sends the mails of DIGEST_WINDOW seconds
+   as one digest and reports the same device in the same state at most once every DEDUP_WINDOW seconds
+   With a METRICS_PORT the daemon serves Prometheus text format metrics on http://METRICS_ADDRESS:port/metrics:
+   cycle duration and failed cycles, device counts by state, schedule lag, and latency and errors of the CVP requests
 
    Requirements:
    python json
@@ -63,13 +76,21 @@ __author__ = 'jkelly@arista.com'
 
 '''
 
+import BaseHTTPServer
 import getopt
 import json
 import logging
 from logging import handlers
 import smtplib
 from email.mime.text import MIMEText
+import os
+import socket
 import sys, time
+import tempfile
+import threading
+import Queue
+import heapq
+import random
 
 try:
     from daemon import Daemon
@@ -94,47 +115,375 @@ EMAILTO = None  # Email To address, use quotes, mandatory if using email
 EMAILPASS = None  # Email password, mandatory if using gmail
 EMAILSERVER = None  # Email server, for gmail, 'smtp.gmail.com' mandatory if using mail
 EMAILPORT = 587  # Email server port, for gmail, 587 is default
+PROBE_WORKERS = 16  # Number of devices probed concurrently, -w on the command line
+PROBE_TIMEOUT = 10  # Seconds a device gets for each of its reachability and compliance calls, -t on the command line
+RECHECK_INTERVAL = 300  # Seconds until a device that changed state or is unreachable is checked again, -r on the command line
+MAX_INTERVAL = 86400  # Longest time in seconds between two checks of a device that stays in compliance, -b on the command line
+JITTER = 0.1  # Fraction of its interval by which the next check of a device is moved at random
+DIGEST_WINDOW = 60  # Seconds the notifier collects reports before mailing them as one digest, --digest on the command line
+DEDUP_WINDOW = 3600  # Seconds during which a device is not reported again in the same state, --dedup on the command line
+NOTIFY_QUEUE = 1000  # Number of reports waiting for the notifier before new ones are dropped
+METRICS_PORT = None  # Local port of the metrics endpoint, None to disable it, --metrics-port on the command line
+METRICS_ADDRESS = '127.0.0.1'  # Address the metrics endpoint listens on
+
+STATEFILE = '/tmp/cvpcompliancecheck.state'  # Last status of every device, kept across restarts, -s on the command line
 
 CURSTATUS = {}
+NOTIFIER = None
 
 assert CVPSERVER is not None
 assert SYSLOGSERVER is not None
 
 class MyDaemon(Daemon):
     def run(self):
+        global CURSTATUS, NOTIFIER
+        CURSTATUS = loadStatus(STATEFILE)
+        NOTIFIER = Notifier(EMAIL, SYSLOG, PRINT, DIGEST_WINDOW, DEDUP_WINDOW)
+        NOTIFIER.start()
+        if METRICS_PORT is not None:
+            startMetricsServer(METRICS_ADDRESS, METRICS_PORT)
+        scheduler = PollScheduler(INTERVAL, RECHECK_INTERVAL, MAX_INTERVAL, JITTER)
         while True:
-            main()
-            time.sleep(INTERVAL)
+            main(scheduler)
+            time.sleep(scheduler.wait(time.time()))
+
+
+class PollScheduler(object):
+    """
+    Priority queue of the next check time of every device, keyed by mac address
+
+    Variables:
+    self.interval - seconds between two device list refreshes, and between two checks of a device
+    that stays out of compliance
+    self.recheck - seconds until a device that changed state or is unreachable is checked again
+    self.maxinterval - longest time between two checks of a device that stays in compliance
+    self.jitter - fraction of its interval by which a check time is moved at random
+    self.devices - mac address to cvp device object, from the last device list refresh
+    self.intervals - mac address to the current check interval of the device
+    self.statuses - mac address to the status code of the last check of the device
+    self.nextcheck - mac address to the time the device is due, entries in the heap with another time are stale
+    self.heap - (time, mac address) entries, the earliest check first
+    self.refreshed - time of the last device list refresh, None before the first one
+    self.lag - seconds the most overdue device of the last due call waited past its check time
+
+    Functions:
+    stale - whether the device list is due for a refresh
+    refresh - take a new device list from CVP, schedule new devices and forget removed ones
+    due - Switch records of the devices whose check time has come
+    reschedule - schedule the next check of probed switches from their status
+    wait - seconds until the next check or device list refresh
+    """
+
+    def __init__(self, interval, recheck, maxinterval, jitter):
+        self.interval = interval
+        self.recheck = min(recheck, interval)
+        self.maxinterval = max(maxinterval, interval)
+        self.jitter = jitter
+        self.devices = {}
+        self.intervals = {}
+        self.statuses = {}
+        self.nextcheck = {}
+        self.heap = []
+        self.refreshed = None
+        self.lag = 0
+
+    def schedule(self, mac, when):
+        self.nextcheck[mac] = when
+        heapq.heappush(self.heap, (when, mac))
+
+    def jittered(self, interval):
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def stale(self, now):
+        return self.refreshed is None or now >= self.refreshed + self.interval
+
+    def refresh(self, devices, now):
+        # New devices, which is every device at startup, get their first check spread over the recheck interval
+        self.devices = dict((device.macAddress, device) for device in devices)
+        for mac in self.devices:
+            if mac not in self.nextcheck:
+                self.intervals[mac] = self.interval
+                self.schedule(mac, now + random.uniform(0, self.recheck))
+        for mac in self.nextcheck.keys():
+            if mac not in self.devices:
+                del self.nextcheck[mac]
+                del self.intervals[mac]
+                self.statuses.pop(mac, None)
+        self.refreshed = now
+
+    def due(self, now):
+        switches = []
+        self.lag = 0
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            when, mac = heapq.heappop(self.heap)
+            if self.nextcheck.get(mac) != when:
+                continue
+            del self.nextcheck[mac]
+            self.lag = max(self.lag, now - when)
+            switches.append(Switch(self.devices[mac]))
+        return switches
+
+    def reschedule(self, switches, now):
+        for switch in switches:
+            mac = switch.macaddress
+            if mac not in self.intervals:
+                continue
+            if switch.status is None:
+                # The compliance check failed, try again soon without changing what is known of the device
+                self.schedule(mac, now + self.jittered(self.recheck))
+                continue
+            previous = self.statuses.get(mac)
+            if switch.status == 0 or (previous is not None and previous != switch.status):
+                interval = self.recheck
+            elif previous is None:
+                interval = self.interval
+            elif switch.status == 2:
+                interval = min(self.intervals[mac] * 2, self.maxinterval)
+            else:
+                interval = self.interval
+            self.intervals[mac] = interval
+            self.statuses[mac] = switch.status
+            self.schedule(mac, now + self.jittered(interval))
+
+    def wait(self, now):
+        if self.refreshed is None:
+            return 1
+        wakeup = self.refreshed + self.interval
+        if len(self.heap) > 0:
+            wakeup = min(wakeup, self.heap[0][0])
+        return max(1, wakeup - now)
+
+class ProbeTimeout(Exception):
+    pass
+
+
+class Histogram(object):
+    """
+    Prometheus histogram of observed values
+
+    Variables:
+    self.buckets - upper bounds of the buckets, in increasing order
+    self.counts - number of observations per bucket, not cumulative
+    self.sum - sum of the observed values
+    self.count - number of observations
+
+    Functions:
+    observe - add one value
+    lines - the histogram in the Prometheus text format
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append('%s_bucket{%sle="%s"} %s' % (name, labels, bound, cumulative))
+        result.append('%s_bucket{%sle="+Inf"} %s' % (name, labels, self.count))
+        labels = labels.rstrip(',')
+        if labels:
+            labels = '{%s}' % labels
+        result.append('%s_sum%s %s' % (name, labels, repr(self.sum)))
+        result.append('%s_count%s %s' % (name, labels, self.count))
+        return result
+
+
+class Metrics(object):
+    """
+    Counters of the daemon, updated by the polling and probe threads and read by the metrics endpoint
+
+    Variables:
+    self.cycles - histogram of the duration of the compliance check cycles that completed
+    self.cycleerrors - number of compliance check cycles that failed
+    self.requests - CVP call name to the histogram of its latency
+    self.errors - CVP call name to the number of calls that failed or timed out
+    self.checked - number of device checks done
+    self.lastcycle - time the last cycle finished, 0 before the first one
+    self.lag - seconds the most overdue device of the last cycle waited past its check time
+
+    Functions:
+    recordCycle - record a completed cycle
+    recordCycleError - record a failed cycle
+    recordRequest - record one CVP call
+    render - all metrics in the Prometheus text format
+    """
+
+    CYCLE_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+    REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cycles = Histogram(self.CYCLE_BUCKETS)
+        self.cycleerrors = 0
+        self.requests = {}
+        self.errors = {}
+        self.checked = 0
+        self.lastcycle = 0
+        self.lag = 0
+
+    def recordCycle(self, duration, checked, lag):
+        with self.lock:
+            self.cycles.observe(duration)
+            self.checked += checked
+            self.lastcycle = time.time()
+            self.lag = lag
+
+    def recordCycleError(self):
+        with self.lock:
+            self.cycleerrors += 1
+
+    def recordRequest(self, call, duration, failed):
+        with self.lock:
+            if call not in self.requests:
+                self.requests[call] = Histogram(self.REQUEST_BUCKETS)
+                self.errors[call] = 0
+            self.requests[call].observe(duration)
+            if failed:
+                self.errors[call] += 1
+
+    def render(self):
+        states = {'unreachable': 0, 'out_of_compliance': 0, 'compliant': 0}
+        for device in CURSTATUS.values():
+            states[('unreachable', 'out_of_compliance', 'compliant')[device['status']]] += 1
+        lines = []
+        with self.lock:
+            lines.append('# HELP compliancecheck_cycle_duration_seconds Duration of the compliance check cycles that completed')
+            lines.append('# TYPE compliancecheck_cycle_duration_seconds histogram')
+            lines.extend(self.cycles.lines('compliancecheck_cycle_duration_seconds'))
+            lines.append('# HELP compliancecheck_cycle_errors_total Number of compliance check cycles that failed')
+            lines.append('# TYPE compliancecheck_cycle_errors_total counter')
+            lines.append('compliancecheck_cycle_errors_total %s' % self.cycleerrors)
+            lines.append('# HELP compliancecheck_last_cycle_timestamp_seconds Time the last compliance check cycle completed')
+            lines.append('# TYPE compliancecheck_last_cycle_timestamp_seconds gauge')
+            lines.append('compliancecheck_last_cycle_timestamp_seconds %s' % repr(self.lastcycle))
+            lines.append('# HELP compliancecheck_schedule_lag_seconds Time the most overdue device of the last cycle waited past its check time')
+            lines.append('# TYPE compliancecheck_schedule_lag_seconds gauge')
+            lines.append('compliancecheck_schedule_lag_seconds %s' % repr(self.lag))
+            lines.append('# HELP compliancecheck_device_checks_total Number of device checks done')
+            lines.append('# TYPE compliancecheck_device_checks_total counter')
+            lines.append('compliancecheck_device_checks_total %s' % self.checked)
+            lines.append('# HELP compliancecheck_devices Number of devices by last known state')
+            lines.append('# TYPE compliancecheck_devices gauge')
+            for state in sorted(states):
+                lines.append('compliancecheck_devices{state="%s"} %s' % (state, states[state]))
+            lines.append('# HELP compliancecheck_cvp_request_duration_seconds Latency of the requests to CVP')
+            lines.append('# TYPE compliancecheck_cvp_request_duration_seconds histogram')
+            for call in sorted(self.requests):
+                lines.extend(self.requests[call].lines('compliancecheck_cvp_request_duration_seconds', 'call="%s",' % call))
+            lines.append('# HELP compliancecheck_cvp_request_errors_total Number of requests to CVP that failed or timed out')
+            lines.append('# TYPE compliancecheck_cvp_request_errors_total counter')
+            for call in sorted(self.errors):
+                lines.append('compliancecheck_cvp_request_errors_total{call="%s"} %s' % (call, self.errors[call]))
+        if NOTIFIER is not None:
+            lines.append('# HELP compliancecheck_notify_queue_length Number of reports waiting for the notifier')
+            lines.append('# TYPE compliancecheck_notify_queue_length gauge')
+            lines.append('compliancecheck_notify_queue_length %s' % NOTIFIER.queue.qsize())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve METRICS on /metrics
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def startMetricsServer(address, port):
+    """
+    Function to serve the metrics endpoint on its own thread
+
+    :return: the HTTP server
+    """
+    httpserver = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=httpserver.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpserver
+
+
+def timedCall(call, function, *args, **kwargs):
+    """
+    Function to make a CVP call and record its latency, and whether it failed, in METRICS
+
+    :param call: name of the call in the metrics
+    """
+    start = time.time()
+    try:
+        result = function(*args, **kwargs)
+    except:
+        METRICS.recordRequest(call, time.time() - start, True)
+        raise
+    METRICS.recordRequest(call, time.time() - start, False)
+    return result
 
 class Switch(object):
     """
-    Define switch properties
+    Define switch properties, one record per device and probe
 
     Variables:
     self.ipaddress - ip address used to manage the switch from CVP
     self.macaddress - mac address of the switch - used by cvp to identify and execute certain tasks
     self.reachable - is the switch reachable, determined by cvp ip reachability check?
     self.compliant - is the switch configuration synchronized with CVP's view of the configuration?
-    self.fqdn - not currently used, theoretically to provide fqdn of switch
+    self.fqdn - fqdn of the switch as known by CVP
+    self.device - the cvp device object, passed to the compliance check
+    self.error - why the probe failed, None when it did not
     self.status - status code, 0, 1, or 2 to determine whether the switch is unreachable, out of compliance,
-    or in compliance
+    or in compliance, None when the probe failed on the CVP side
 
     Functions:
     makestatus - returns status information of a given switch
 
     """
 
-    def __init__(self):
+    def __init__(self, device=None):
         self.ipaddress = None
         self.macaddress = None
         self.reachable = None
         self.compliant = None
         self.fqdn = None
+        self.device = device
+        self.error = None
         self.status = None
+        if device is not None:
+            self.ipaddress = device.ipAddress
+            self.macaddress = device.macAddress
+            self.fqdn = getattr(device, 'fqdn', None)
 
     def makestatus(self):
         if self.reachable is False:
             self.status = 0
+        elif self.error is not None:
+            self.status = None
         else:
             if self.compliant is True:
                 self.status = 2
@@ -142,14 +491,12 @@ class Switch(object):
                 self.status = 1
         return self.status
 
-switchstatus = Switch()
-
-
-def getComplianceList():
+def getComplianceList(switches=None):
 
     """
     Function to generate lists of which switches are reachable, and which are out of compliance
 
+    :param switches: Switch records to probe, all devices in CVP when None
     :return:
       unreachable - list of unreachable devices
       outofcompliance - list of devices out of config compliance
@@ -157,67 +504,217 @@ def getComplianceList():
     global CURSTATUS
     unreachable = []
     outofcompliance = []
-    # Pull the list of devices from CVP
-    devicelist = getDeviceLists()
-    # iterate through list, check if device is reachable first, then if so, check compliance
-    for device in devicelist:
+    changed = False
+    # Pull the list of devices from CVP unless given, and probe them concurrently
+    if switches is None:
+        switches = getDeviceLists()
+    switches = probeDevices(switches, PROBE_WORKERS, PROBE_TIMEOUT)
+    # create lists for unreachables and out of compliance switches from the status codes
+    # CURSTATUS is keyed by mac address, the ip address of a device can change
+    for switch in switches:
+        status = switch.makestatus()
+        if status is None:
+            print "Probe of %s failed, keeping its last status: %s" % (switch.ipaddress, switch.error)
+            continue
         try:
-            switchstatus.reachable = checkDeviceStatus(devicelist[device])
-            switchstatus.ipaddress = devicelist[device]
-            if switchstatus.reachable is True:
-                switchstatus.compliant = server.deviceComplianceCheck(device)
-        except:
-            raise
-        # get the status code and create lists for unreachables and out of compliance switches
-        status = switchstatus.makestatus()
-        try:
-            if status == CURSTATUS[switchstatus.ipaddress]:
+            if status == CURSTATUS[switch.macaddress]['status']:
+                if CURSTATUS[switch.macaddress]['ipaddress'] != switch.ipaddress:
+                    CURSTATUS[switch.macaddress]['ipaddress'] = switch.ipaddress
+                    changed = True
                 continue
 
         except KeyError:
-            CURSTATUS[switchstatus.ipaddress] = status
+            pass
         except:
             raise
 
         if status == 0:
-            unreachable.append(switchstatus.ipaddress)
+            unreachable.append(switch.ipaddress)
         elif status == 1:
-            outofcompliance.append(switchstatus.ipaddress)
-        CURSTATUS[switchstatus.ipaddress] = status
-
+            outofcompliance.append(switch.ipaddress)
+        CURSTATUS[switch.macaddress] = {'status': status, 'ipaddress': switch.ipaddress, 'fqdn': switch.fqdn}
+        changed = True
 
+    if changed:
+        saveStatus(STATEFILE, CURSTATUS)
 
     return unreachable, outofcompliance  #, CURSTATUS
 
 
+def loadStatus(filename):
+    """
+    Function to load the last status of every device saved by saveStatus
+
+    :param filename: state file, a missing or unreadable file gives an empty status
+    :return: dictionary of mac address to {'status', 'ipaddress', 'fqdn'}
+    """
+    try:
+        with open(filename) as statefile:
+            status = json.load(statefile)
+    except IOError:
+        return {}
+    except ValueError as e:
+        print "Ignoring unreadable state file %s: %s" % (filename, e)
+        return {}
+    if not isinstance(status, dict):
+        return {}
+    return status
+
+
+def saveStatus(filename, status):
+    """
+    Function to save the status of every device. The status is written to a temporary file in the same
+    directory which is then renamed over the state file, so a crash never leaves a partial state file.
+
+    :param filename: state file
+    :param status: dictionary of mac address to {'status', 'ipaddress', 'fqdn'}
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    descriptor, tempname = tempfile.mkstemp(prefix='.cvpcompliancecheck', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'w') as statefile:
+            json.dump(status, statefile, sort_keys=True)
+            statefile.flush()
+            os.fsync(statefile.fileno())
+        os.rename(tempname, filename)
+    except:
+        os.unlink(tempname)
+        raise
+
+
+def forgetDevices(macaddresses):
+    """
+    Function to drop the status of devices that are no longer in CVP
+
+    :param macaddresses: mac addresses of the devices CVP knows
+    """
+    removed = [mac for mac in CURSTATUS if mac not in macaddresses]
+    for mac in removed:
+        del CURSTATUS[mac]
+    if len(removed) > 0:
+        saveStatus(STATEFILE, CURSTATUS)
+
+
 def getDeviceLists():
     """
     Function to pull list of devices from CVP
 
     Returns:
-    devices - dictionary of devices as kv pair mac_address: ip_address
+    devices - list of Switch records, one per device, in the order CVP lists them
+    """
+
+    return [Switch(device) for device in timedCall('getDevices', server.getDevices)]
+
+
+def callWithTimeout(function, args, timeout):
+    """
+    Run function on its own thread and wait at most timeout seconds for it. The cvp module has no
+    timeout on its calls, a call that does not return in time is left to finish in the background.
+
+    :raise ProbeTimeout: when the call did not return in time
+    """
+    result = {}
+
+    def call():
+        try:
+            result['value'] = function(*args)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise ProbeTimeout('no answer in %s seconds' % timeout)
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def isCompliant(compliance):
+    """
+    deviceComplianceCheck returns a compliance code where 0 means in compliance, older cvp modules a boolean
+    """
+    if isinstance(compliance, bool):
+        return compliance
+    return compliance == 0
+
+
+def probeDevice(switch, timeout):
+    """
+    Probe one switch: reachability test first, compliance check only when it is reachable.
+    Fills in the reachable, compliant and error fields of the record. Only CVP's answer to the reachability
+    test makes a switch unreachable. When CVP does not answer the test, or the compliance check fails or
+    times out, only error is set, except for HTTP errors from CVP, which are raised for main to handle.
     """
+    try:
+        switch.reachable = checkDeviceStatus(switch.ipaddress, timeout)
+    except (requests.Timeout, requests.ConnectionError) as e:
+        switch.error = "no answer from CVP to the reachability test: %s" % e
+        return switch
+    if switch.reachable is True:
+        try:
+            switch.compliant = isCompliant(timedCall('deviceComplianceCheck', callWithTimeout, server.deviceComplianceCheck, (switch.device,), timeout))
+        except requests.HTTPError:
+            raise
+        except Exception as e:
+            switch.error = str(e)
+    return switch
 
-    devices = {}
-    devicelist = server.getDevices()
-    for device in devicelist:
-        devices[device.macAddress] = device.ipAddress
-    return devices
 
+def probeDevices(switches, workers, timeout):
+    """
+    Probe the switches on a bounded number of worker threads.
 
-def checkDeviceStatus(device):
+    :param switches: list of Switch records
+    :param workers: number of switches probed at the same time
+    :param timeout: seconds each call for a switch may take
+    :return: the list of switches, probed, in the same order
+    :raise: the first error a probe raised, after the workers stopped
+    """
+    queue = Queue.Queue()
+    for switch in switches:
+        queue.put(switch)
+    errors = []
+
+    def worker():
+        while len(errors) == 0:
+            try:
+                switch = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                probeDevice(switch, timeout)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for counter in range(max(1, min(workers, len(switches))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return switches
+
+
+def checkDeviceStatus(device, timeout=None):
     """
     Function to check reachability of a switch, calls cvp ipConnectivityTest
 
     :param device: device ip address, used by cvp api to check reachability
+    :param timeout: seconds to wait for CVP to answer the test
 
     :return:
-    reachable - whether or not the switch is reachable
+    reachable - whether or not the switch is reachable, as answered by CVP
+    :raise requests.Timeout, requests.ConnectionError: when CVP itself did not answer
     """
     data = {"ipAddress": device}
     try:
         #print server.cvpService.url, data
-        pingstatus = server.cvpService.doRequest( requests.post, '%s/web/provisioning/ipConnectivityTest.do' % server.cvpService.url, data=json.dumps(data), cookies=server.cvpService.cookies)
+        pingstatus = timedCall('ipConnectivityTest', server.cvpService.doRequest, requests.post, '%s/web/provisioning/ipConnectivityTest.do' % server.cvpService.url, data=json.dumps(data), cookies=server.cvpService.cookies, timeout=timeout)
         if pingstatus['data'] == 'success':
             reachable = True
         else:
@@ -242,21 +739,35 @@ def sendMail(switchlist, text):
     body = text + "\n"
     for switch in switchlist:
         body += switch + "\n"
-    msg = MIMEText(body)
-    msg['Subject'] = text
-    msg['From'] = EMAILFROM
-    msg['To'] = EMAILTO
-    msg = msg.as_string()
     try:
-        emailserver = smtplib.SMTP(EMAILSERVER, EMAILPORT)
-        emailserver.starttls()
-        emailserver.login(EMAILFROM, EMAILPASS)
-        emailserver.sendmail(EMAILFROM, EMAILTO, msg)
+        emailserver = openMail()
+        emailserver.sendmail(EMAILFROM, EMAILTO, mailMessage(text, body))
         emailserver.quit()
     except:
         raise
 
 
+def mailMessage(subject, body):
+    """
+    Function to build the email message sent to the configured recipient
+    """
+    msg = MIMEText(body)
+    msg['Subject'] = subject
+    msg['From'] = EMAILFROM
+    msg['To'] = EMAILTO
+    return msg.as_string()
+
+
+def openMail():
+    """
+    Function to open an SMTP session to the configured email server, logged in with starttls
+    """
+    emailserver = smtplib.SMTP(EMAILSERVER, EMAILPORT)
+    emailserver.starttls()
+    emailserver.login(EMAILFROM, EMAILPASS)
+    return emailserver
+
+
 def sendSyslog(switchlist, text):
     """
     Function to send a syslog message for each unreachable and out of compliance switch
@@ -265,18 +776,31 @@ def sendSyslog(switchlist, text):
     :param text: Initial text of syslog message, indicates type of message
     """
 
+    cvplogger, loghandlers = openLogger()
+    for switch in switchlist:
+        cvplogger.critical('%s %s' % (text, switch))
+    closeLogger(cvplogger, loghandlers)
+
+
+def openLogger():
+    """
+    Function to attach the syslog and terminal handlers to the CvpLogger logger
+
+    :return: the logger and the list of handlers attached to it
+    """
     cvplogger = logging.getLogger('CvpLogger')
     cvplogger.setLevel(logging.WARNING)
     termlogger = logging.StreamHandler(sys.stdout)
     logwriter = logging.handlers.SysLogHandler(address= SYSLOGSERVER)  #, 514))
     cvplogger.addHandler(logwriter)
     cvplogger.addHandler(termlogger)
-    for switch in switchlist:
-        cvplogger.critical('%s %s' % (text, switch))
-    logwriter.close()
-    cvplogger.removeHandler(logwriter)
-    termlogger.close()
-    cvplogger.removeHandler(termlogger)
+    return cvplogger, [logwriter, termlogger]
+
+
+def closeLogger(cvplogger, loghandlers):
+    for handler in loghandlers:
+        handler.close()
+        cvplogger.removeHandler(handler)
 
 
 def printer(switchlist, text):
@@ -293,18 +817,144 @@ def printer(switchlist, text):
         print switch
 
 
-def notify(switchlist, text, EMAIL, SYSLOG, PRINT):
+class Notifier(threading.Thread):
+    """
+    Thread that sends the notifications queued by notify, off the polling thread
+
+    Variables:
+    self.email, self.syslog, self.printing - where reports are sent
+    self.digest - seconds reports are collected before they are mailed as one digest
+    self.dedup - seconds during which a device is not reported again in the same state
+    self.queue - (switchlist, text, state) reports waiting to be sent
+    self.sent - (state, switch) to the time the switch was last reported in that state
+    self.pending - (text, switchlist) reports waiting for the next digest mail
+    self.deadline - time the next digest mail is due, None when no report is waiting
+    self.emailserver - SMTP session kept open between mails, None when not connected
+    self.cvplogger, self.loghandlers - logger and its handlers kept open for syslog reports
+
+    Functions:
+    submit - queue a report, never blocks, the report is dropped when the queue is full
+    run - send reports as they arrive and mail the digest when it is due
     """
-    Function to determine where results are sent
+
+    def __init__(self, email, syslog, printing, digest, dedup):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.email = email
+        self.syslog = syslog
+        self.printing = printing
+        self.digest = digest
+        self.dedup = dedup
+        self.queue = Queue.Queue(NOTIFY_QUEUE)
+        self.sent = {}
+        self.pending = []
+        self.deadline = None
+        self.emailserver = None
+        self.cvplogger = None
+        self.loghandlers = []
+
+    def submit(self, switchlist, text, state):
+        try:
+            self.queue.put_nowait((switchlist, text, state))
+        except Queue.Full:
+            print "Notification queue full, dropping report: %s %s" % (text, ", ".join(switchlist))
+
+    def run(self):
+        if self.syslog is True:
+            try:
+                self.cvplogger, self.loghandlers = openLogger()
+            except Exception as e:
+                print "Error opening syslog, reports are not sent to syslog: %s" % e
+                self.syslog = False
+        while True:
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0, self.deadline - time.time())
+            try:
+                self.report(*self.queue.get(True, timeout))
+            except Queue.Empty:
+                pass
+            if self.deadline is not None and time.time() >= self.deadline:
+                self.mailDigest()
+
+    def report(self, switchlist, text, state):
+        now = time.time()
+        for key in [key for key in self.sent if now - self.sent[key] >= self.dedup]:
+            del self.sent[key]
+        switchlist = [switch for switch in switchlist if (state, switch) not in self.sent]
+        if len(switchlist) == 0:
+            return
+        for switch in switchlist:
+            self.sent[(state, switch)] = now
+        if self.printing is True:
+            printer(switchlist, text)
+        if self.syslog is True:
+            try:
+                for switch in switchlist:
+                    self.cvplogger.critical('%s %s' % (text, switch))
+            except Exception as e:
+                print "Error sending syslog report: %s" % e
+        if self.email is True:
+            self.pending.append((text, switchlist))
+            if self.deadline is None:
+                self.deadline = now + self.digest
+
+    def mailDigest(self):
+        if len(self.pending) == 1:
+            subject = self.pending[0][0]
+        else:
+            subject = "%s CVP_Compliance_Checker: DIGEST of %s reports" % (time.asctime(), len(self.pending))
+        body = ""
+        for text, switchlist in self.pending:
+            body += text + "\n"
+            for switch in switchlist:
+                body += switch + "\n"
+            body += "\n"
+        self.pending = []
+        self.deadline = None
+        try:
+            self.sendMail(mailMessage(subject, body))
+        except Exception as e:
+            print "Error sending report email: %s" % e
+
+    def sendMail(self, msg):
+        # The server may have closed the idle session since the last mail, reconnect once
+        for attempt in range(2):
+            try:
+                if self.emailserver is None:
+                    self.emailserver = openMail()
+                self.emailserver.sendmail(EMAILFROM, EMAILTO, msg)
+                return
+            except (smtplib.SMTPException, socket.error):
+                self.closeMail()
+                if attempt == 1:
+                    raise
+
+    def closeMail(self):
+        try:
+            if self.emailserver is not None:
+                self.emailserver.close()
+        finally:
+            self.emailserver = None
+
+
+def notify(switchlist, text, EMAIL, SYSLOG, PRINT, state=None):
+    """
+    Function to determine where results are sent. When the notifier thread runs the report is queued to it,
+    otherwise it is sent right away.
 
     :param switchlist: list of switches which are either unreachable or out of compliance
     :param text: Initial text of message, indicates type of message
     :param EMAIL: Whether or not to email the message to the configured server and recipient
     :param SYSLOG: Whether or not to syslog the message to the configured syslog server
     :param PRINT: Whether or not to print the results to the local terminal
+    :param state: state the switches are reported in, used by the notifier to drop duplicate reports
 
     """
 
+    if NOTIFIER is not None:
+        NOTIFIER.submit(switchlist, text, state or text)
+        return
     if PRINT is True:
         printer(switchlist, text)
     if EMAIL is True:
@@ -314,7 +964,7 @@ def notify(switchlist, text, EMAIL, SYSLOG, PRINT):
 
 
 def usage():
-    print "usage:compliancecheck.py (start|stop|restart) -i <interval seconds> -u <cvp username> -p <cvp password> --mail --syslog --print"
+    print "usage:compliancecheck.py (start|stop|restart) -i <interval seconds> -u <cvp username> -p <cvp password> -w <probe workers> -t <probe timeout seconds> -r <recheck seconds> -b <max interval seconds> -s <state file> --digest <seconds> --dedup <seconds> --metrics-port <port> --mail --syslog --print"
 
 
 def getargs(argv):
@@ -330,7 +980,7 @@ def getargs(argv):
     SYSLOG - Send syslong or not, boolean, default to false from global config
     PRINT - Print locally or not, boolean, default to false from global config
     """
-    global MIN_INTERVAL  #, EMAIL, CVPUSER, CVPPASS, SYSLOG, PRINT, INTERVAL, RUN
+    global MIN_INTERVAL, PROBE_WORKERS, PROBE_TIMEOUT, RECHECK_INTERVAL, MAX_INTERVAL, STATEFILE, DIGEST_WINDOW, DEDUP_WINDOW, METRICS_PORT  #, EMAIL, CVPUSER, CVPPASS, SYSLOG, PRINT, INTERVAL, RUN
     INTERVAL = 3600  # How frequently to call script
     CVPUSER = None
     CVPPASS = None
@@ -343,7 +993,7 @@ def getargs(argv):
 
     if not len(argv) == 1:
         try:
-            opts, args = getopt.getopt(argv, "hi:u:p:", ["mail", "syslog", "print", "daemonize", "run"])
+            opts, args = getopt.getopt(argv, "hi:u:p:w:t:r:b:s:", ["mail", "syslog", "print", "daemonize", "run", "digest=", "dedup=", "metrics-port="])
         except getopt.GetoptError:
             usage()
             sys.exit(2)
@@ -362,6 +1012,22 @@ def getargs(argv):
                 CVPUSER = arg
             elif opt == "-p":
                 CVPPASS = arg
+            elif opt == "-w":
+                PROBE_WORKERS = max(1, int(arg))
+            elif opt == "-t":
+                PROBE_TIMEOUT = float(arg)
+            elif opt == "-r":
+                RECHECK_INTERVAL = int(arg)
+            elif opt == "-b":
+                MAX_INTERVAL = int(arg)
+            elif opt == "-s":
+                STATEFILE = arg
+            elif opt == "--digest":
+                DIGEST_WINDOW = int(arg)
+            elif opt == "--dedup":
+                DEDUP_WINDOW = int(arg)
+            elif opt == "--metrics-port":
+                METRICS_PORT = int(arg)
             elif opt == "--mail":
                 assert EMAILFROM is not None
                 assert EMAILTO is not None
@@ -383,7 +1049,11 @@ def getargs(argv):
     return INTERVAL, CVPUSER, CVPPASS, EMAIL, SYSLOG, PRINT
 
 
-def main():
+def main(scheduler=None):
+    """
+    One compliance check. Without a scheduler every device is checked, with one only the devices that
+    are due, and the connection to CVP and the device list are refreshed once every interval.
+    """
     if SYSLOG is True:
         assert SYSLOGSERVER is not None
     if EMAIL is True:
@@ -391,12 +1061,19 @@ def main():
         assert EMAILTO is not None
         assert EMAILPASS is not None
         assert EMAILSERVER is not None
+    now = time.time()
+    failed = False
     try:
         global server
-        server = cvp.Cvp(CVPSERVER)
-        server.authenticate(CVPUSER, CVPPASS)
+        if scheduler is None or scheduler.stale(now):
+            server = cvp.Cvp(CVPSERVER)
+            timedCall('authenticate', server.authenticate, CVPUSER, CVPPASS)
+            if scheduler is not None:
+                scheduler.refresh(timedCall('getDevices', server.getDevices), now)
+                forgetDevices(scheduler.devices)
     except requests.HTTPError as e:
         print "Error connecting to CVP Server, trying again in 60 seconds: %s" % str(e)
+        failed = True
         time.sleep(60)
     except packages.urllib3.exceptions.ProtocolError as e:
         if str(e) == "('Connection aborted.', gaierror(8, 'nodename nor servname provided, or not known'))":
@@ -404,23 +1081,35 @@ def main():
             sys.exit(2)
         elif str(e) == "('Connection aborted.', error(54, 'Connection reset by peer'))":
             print "Error, connection aborted"
+            failed = True
         else:
             raise
     except:
         raise
+    switches = None
+    lag = 0
+    if scheduler is not None:
+        switches = scheduler.due(now)
+        if len(switches) == 0:
+            return
+        lag = scheduler.lag
     try:
-        unreachable, outofcompliance = getComplianceList()
+        unreachable, outofcompliance = getComplianceList(switches)
         # If there are any unreachable switches, send the list to the notify function for reporting
         if len(unreachable) > 0:
             text = "%s CVP_Compliance_Checker: UNREACHABLE: " % time.asctime()
-            notify(unreachable, text, EMAIL, SYSLOG, PRINT)
+            notify(unreachable, text, EMAIL, SYSLOG, PRINT, 'UNREACHABLE')
         # If there are switches out of compliance, send the list to notify function for reporting
         if len(outofcompliance) > 0:
             text = "%s CVP_Compliance_Checker: OUT_OF_COMPLIANCE: " % time.asctime()
-            notify(outofcompliance, text, EMAIL, SYSLOG, PRINT)
+            notify(outofcompliance, text, EMAIL, SYSLOG, PRINT, 'OUT_OF_COMPLIANCE')
     # If CVP can't be reached, try again in 1 minute, could probably use a counter to abort after x tries
     except requests.HTTPError as e:
         print "Error reaching CVP server, trying again in 60 seconds %s" % str(e)
+        # The session may have expired, authenticate and refresh the device list on the next wake up
+        if scheduler is not None:
+            scheduler.refreshed = None
+        failed = True
         time.sleep(60)
         #continue
     except packages.urllib3.exceptions.ProtocolError as e:
@@ -431,8 +1120,19 @@ def main():
             raise
     except:
         raise
+    finally:
+        # Switches whose probe did not complete still have status None and are checked again soon
+        if scheduler is not None:
+            scheduler.reschedule(switches, time.time())
+    if failed:
+        METRICS.recordCycleError()
+        return
+    METRICS.recordCycle(time.time() - now, len(switches) if switches is not None else len(CURSTATUS), lag)
     print "#"*120
-    print "Executing Compliance Check @ ", time.asctime()
+    if switches is None:
+        print "Executing Compliance Check @ ", time.asctime()
+    else:
+        print "Executing Compliance Check of %s devices @ " % len(switches), time.asctime()
     print "#"*120
 
 